@@ -0,0 +1,96 @@
+import logging
+from typing import Callable
+
+import torch
+from transformers.models.auto import AutoModelForSeq2SeqLM
+
+logger = logging.getLogger(__name__)
+
+INFERENCE_BACKENDS = ("fp32", "int8", "bf16", "onnx")
+
+
+def bf16_supported() -> bool:
+    try:
+        a = torch.ones(2, 2, dtype=torch.bfloat16)
+        torch.nn.functional.linear(a, a)
+        return True
+    except RuntimeError:
+        return False
+
+
+def check_backend(backend: str) -> None:
+    """
+    Raises ValueError if `backend` is unknown.
+    """
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(
+            f"unknown inference backend {backend}, expected one of {', '.join(INFERENCE_BACKENDS)}")
+
+
+def _ort_model_cls() -> type:
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError:
+        raise ValueError(
+            "the onnx inference backend requires optimum[onnxruntime]")
+    return ORTModelForSeq2SeqLM
+
+
+def _ort_auto_model(config) -> type:
+    """
+    Stands in for `AutoModelForSeq2SeqLM` with the ORT model of optimum, exported from the
+    checkpoint when loaded. Model class wrappers like `with_picard` resolve the model class of
+    `config` through `_model_mapping` and override its `generate`, which the ORT model
+    inherits from transformers, so they wrap it like the eager models.
+    """
+    base_cls = _ort_model_cls()
+
+    class ORTModel(base_cls):
+        @classmethod
+        def from_pretrained(cls, model_path, *args, _from_auto: bool = False, **kwargs):
+            try:
+                return super().from_pretrained(model_path, *args, export=True, use_cache=True, **kwargs)
+            except TypeError:
+                # optimum < 1.6
+                return super().from_pretrained(model_path, *args, from_transformers=True, use_cache=True, **kwargs)
+
+    class ORTAutoModel:
+        _model_mapping = {type(config): ORTModel}
+
+        @classmethod
+        def from_pretrained(cls, *args, **kwargs):
+            return ORTModel.from_pretrained(*args, **kwargs)
+
+    return ORTAutoModel
+
+
+def load_model(model_cls_wrapper: Callable[[type], type], model_path: str, config, backend: str = "fp32", **kwargs):
+    """
+    Loads the seq2seq model at `model_path` for inference with `backend`:
+
+    - fp32: the eager model, as trained;
+    - int8: the eager model with its Linear layers dynamically quantized to int8;
+    - bf16: the eager model in bfloat16, if this CPU and build of torch support it;
+    - onnx: the encoder and the decoder (with its KV cache) exported to ONNX Runtime,
+      through optimum, which must be installed.
+
+    `model_cls_wrapper` (e.g. `with_picard`) wraps the model class in all cases, so that the
+    PICARD logits processor applies to every backend. `kwargs` go to `from_pretrained`.
+    """
+    check_backend(backend)
+    if backend == "onnx":
+        return model_cls_wrapper(_ort_auto_model(config)).from_pretrained(model_path, config=config, **kwargs)
+
+    model = model_cls_wrapper(AutoModelForSeq2SeqLM).from_pretrained(
+        model_path, config=config, **kwargs)
+    model.eval()
+    if backend == "int8":
+        # in place, not to hold both copies of the weights
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif backend == "bf16":
+        if not bf16_supported():
+            raise ValueError(
+                "the bf16 inference backend is not supported by this CPU or build of torch")
+        model = model.to(torch.bfloat16)
+    return model
@@ -0,0 +1,79 @@
+import asyncio
+import json
+from dataclasses import dataclass
+from itertools import islice
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional, TypeVar
+
+T = TypeVar("T")
+Q = TypeVar("Q")
+
+
+@dataclass
+class BatchQuestion:
+    db_id: str
+    question: str
+    # echoed back with the answer, e.g. the index of the question in an evaluation set
+    id: Optional[object] = None
+
+
+def parse_questions(items: object) -> List[BatchQuestion]:
+    """
+    Questions of a POST /ask/batch body: a list of `[db_id, question]` pairs or of
+    `{"db_id": ..., "question": ..., "id": ...}` objects. Raises ValueError.
+    """
+    if not isinstance(items, list):
+        raise ValueError("expected a list of questions")
+    questions = []
+    for i, item in enumerate(items):
+        if isinstance(item, dict):
+            question = BatchQuestion(
+                item.get("db_id"), item.get("question"), item.get("id"))
+        elif isinstance(item, (list, tuple)) and len(item) == 2:
+            question = BatchQuestion(*item)
+        else:
+            raise ValueError(
+                f"question {i} is neither a [db_id, question] pair nor an object")
+        if not isinstance(question.db_id, str) or not question.db_id \
+                or not isinstance(question.question, str) or not question.question:
+            raise ValueError(f"question {i} lacks a db_id or a question")
+        questions.append(question)
+    return questions
+
+
+def read_jsonl(data: bytes) -> List[BatchQuestion]:
+    """
+    Questions of a JSONL file, one pair or object (see `parse_questions`) per line.
+    """
+    items = []
+    for number, line in enumerate(data.decode("utf-8").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except json.JSONDecodeError as e:
+            raise ValueError(f"line {number} is not valid JSON: {e.msg}")
+    return parse_questions(items)
+
+
+async def completed(
+    questions: Iterable[Q], answer: Callable[[Q], Awaitable[T]], window: int
+) -> AsyncIterator[T]:
+    """
+    Yields `answer(question)` for all `questions` in the order they complete, with at most
+    `window` of them in flight, so that a large batch does not fill the queues at once.
+    Answers still running are cancelled when the consumer stops early.
+    """
+    questions = iter(questions)
+    pending = set()
+    try:
+        while True:
+            for question in islice(questions, max(1, window) - len(pending)):
+                pending.add(asyncio.ensure_future(answer(question)))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
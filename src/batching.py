@@ -0,0 +1,196 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Executor, Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from seq2seq.utils.pipeline import Text2SQLInput
+
+from executors import Overloaded
+from serving_pipeline import Text2SQLServingPipeline
+
+logger = logging.getLogger(__name__)
+
+
+def generate_batch(
+    pipe: Text2SQLServingPipeline,
+    inputs: List[Text2SQLInput],
+    num_return_sequences: int,
+    timings: Optional[Dict[str, float]] = None,
+) -> List[object]:
+    """
+    Runs a single padded beam search over all `inputs`.
+
+    Returns, for every input, either its list of generated records or the exception raised
+    while encoding it (e.g. an unknown db_id), so that one bad input does not fail the batch.
+    When given, `timings` receives the seconds spent per stage ("schema", "tokenize",
+    "generate" including "picard", "decode"), the number of generated "tokens" and the
+    number of tokens "rejected" by PICARD.
+    """
+    if timings is None:
+        timings = {}
+    results: List[object] = [None] * len(inputs)
+    token_ids, indices = [], []
+    for i, input in enumerate(inputs):
+        try:
+            token_ids.append(pipe.encode(input, timings))
+            indices.append(i)
+        except Exception as e:
+            results[i] = e
+    if not token_ids:
+        return results
+
+    start = time.perf_counter()
+    pipe.picard_usage.reset()
+    model_outputs = pipe.forward(
+        pipe.collate(token_ids), num_return_sequences=num_return_sequences)
+    generated = time.perf_counter()
+    output_ids = model_outputs["output_ids"]
+    for row, i in enumerate(indices):
+        results[i] = pipe.postprocess({"output_ids": output_ids[row:row + 1]})
+    timings["generate"] = generated - start
+    timings["picard"] = pipe.picard_usage.seconds
+    timings["decode"] = time.perf_counter() - generated
+    timings["tokens"] = int(
+        (output_ids != pipe.tokenizer.pad_token_id).sum())
+    timings["rejected"] = pipe.picard_usage.rejected
+    return results
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent generation requests into batched calls of the pipeline.
+
+    A background thread waits for the first pending request, then keeps collecting requests
+    for up to `max_wait_ms` milliseconds or until `max_batch_size` are pending, and runs them
+    as a single padded `generate()` call. PICARD constrains every sequence of the batch
+    against the schema of its own db_id. Results are fanned back out through futures.
+
+    Batches run on `executor` (inline on the background thread when None), at most
+    `max_concurrent_batches` at a time; requests arriving meanwhile are batched together.
+    `submit` raises `Overloaded` once `max_pending` requests are queued or running.
+
+    `on_batch(size, timings)` is called after every batch with the timings of
+    `generate_batch`. The futures returned by `submit` carry the `timings` of their batch,
+    plus the seconds they spent in the "queue".
+    """
+
+    def __init__(
+        self,
+        pipe: Text2SQLServingPipeline,
+        num_return_sequences: int = 1,
+        max_batch_size: int = 8,
+        max_wait_ms: float = 10.0,
+        executor: Optional[Executor] = None,
+        max_concurrent_batches: int = 1,
+        max_pending: int = 0,
+        on_batch: Optional[Callable[[int, Dict[str, float]], None]] = None,
+    ):
+        self.pipe = pipe
+        self.num_return_sequences = num_return_sequences
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.executor = executor
+        self.max_pending = max_pending
+        self.on_batch = on_batch
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max(1, max_concurrent_batches))
+        self._queue: "queue.Queue[Optional[Tuple[Text2SQLInput, Future]]]" = queue.Queue()
+        # started on first use, so that the batcher can be created before forking workers
+        self._thread: Optional[threading.Thread] = None
+
+    def __call__(self, input: Text2SQLInput) -> List[dict]:
+        return self.submit(input).result()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, input: Text2SQLInput) -> Future:
+        with self._lock:
+            if self.max_pending and self._pending >= self.max_pending:
+                raise Overloaded(
+                    f"{self._pending} questions are already pending")
+            self._pending += 1
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="micro-batcher", daemon=True)
+                self._thread.start()
+        future = Future()
+        future.submitted = time.perf_counter()
+        future.timings = {}
+        future.add_done_callback(self._done)
+        self._queue.put((input, future))
+        return future
+
+    def _done(self, _future: Future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def close(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _collect(self, first: Tuple[Text2SQLInput, Future]) -> Tuple[list, bool]:
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self) -> None:
+        closed = False
+        while not closed:
+            first = self._queue.get()
+            if first is None:
+                break
+            # wait for a free slot first, so that requests queue up into a larger batch
+            self._slots.acquire()
+            batch, closed = self._collect(first)
+            batch = [(input, future) for input, future in batch
+                     if future.set_running_or_notify_cancel()]
+            if not batch:
+                self._slots.release()
+            elif self.executor is not None:
+                self.executor.submit(self._execute, batch)
+            else:
+                self._execute(batch)
+
+    def _execute(self, batch: List[Tuple[Text2SQLInput, Future]]) -> None:
+        try:
+            self._generate(batch)
+        finally:
+            self._slots.release()
+
+    def _generate(self, batch: List[Tuple[Text2SQLInput, Future]]) -> None:
+        start = time.perf_counter()
+        timings: Dict[str, float] = {}
+        try:
+            results = generate_batch(
+                self.pipe, [input for input, _ in batch], self.num_return_sequences, timings)
+        except Exception as e:
+            logger.exception(f"Batch of {len(batch)} failed")
+            results = [e] * len(batch)
+        if self.on_batch is not None:
+            try:
+                self.on_batch(len(batch), timings)
+            except Exception:
+                logger.exception("on_batch failed")
+        for (_, future), result in zip(batch, results):
+            future.timings = dict(timings, queue=start - future.submitted)
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
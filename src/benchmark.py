@@ -0,0 +1,534 @@
+import json
+import os
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+# Offline benchmark of the serving path: the pipeline, the REST API driven in-process and
+# the SQL execution, over a fixed question set against generated SQLite databases. By
+# default the model is a tiny T5 with random weights and a word-level tokenizer, built
+# locally, so that it runs on a CPU-only box without network access. PICARD is not used.
+#
+#     python benchmark.py --output results.json [--compare previous.json]
+#
+# Inference backends are compared on the same questions with --backends fp32,int8,bf16,onnx;
+# accuracy is only meaningful with a trained model (--model_path and the same --db_path
+# contents as the generated databases).
+#
+# Heavy imports are deferred to the functions that need them, so that the cold start is
+# measured on a fresh process.
+
+# (db_id, question, gold query)
+QUESTIONS: List[Tuple[str, str, str]] = [
+    ("concert_singer", "How many singers do we have?",
+     "SELECT count(*) FROM singer"),
+    ("concert_singer", "What is the average age of all singers from France?",
+     "SELECT avg(age) FROM singer WHERE country = 'France'"),
+    ("concert_singer", "Show the name and capacity of the stadium with the most concerts.",
+     "SELECT T2.name, T2.capacity FROM concert AS T1 JOIN stadium AS T2 ON T1.stadium_id = T2.stadium_id GROUP BY T1.stadium_id ORDER BY count(*) DESC LIMIT 1"),
+    ("concert_singer", "List all singer names in concerts in year 2014.",
+     "SELECT T2.name FROM singer_in_concert AS T1 JOIN singer AS T2 ON T1.singer_id = T2.singer_id JOIN concert AS T3 ON T1.concert_id = T3.concert_id WHERE T3.year = 2014"),
+    ("concert_singer", "What are the names of the stadiums without any concerts?",
+     "SELECT name FROM stadium WHERE stadium_id NOT IN (SELECT stadium_id FROM concert)"),
+    ("concert_singer", "How many concerts are there in each year?",
+     "SELECT year, count(*) FROM concert GROUP BY year"),
+    ("pets_1", "Find the number of pets whose weight is heavier than 10.",
+     "SELECT count(*) FROM pets WHERE weight > 10"),
+    ("pets_1", "What is the average age of the students who have a dog?",
+     "SELECT avg(T1.age) FROM student AS T1 JOIN has_pet AS T2 ON T1.stu_id = T2.stu_id JOIN pets AS T3 ON T2.pet_id = T3.pet_id WHERE T3.pet_type = 'dog'"),
+    ("pets_1", "Find the first name of students who have both cat and dog pets.",
+     "SELECT T1.fname FROM student AS T1 JOIN has_pet AS T2 ON T1.stu_id = T2.stu_id JOIN pets AS T3 ON T3.pet_id = T2.pet_id WHERE T3.pet_type = 'cat' INTERSECT SELECT T1.fname FROM student AS T1 JOIN has_pet AS T2 ON T1.stu_id = T2.stu_id JOIN pets AS T3 ON T3.pet_id = T2.pet_id WHERE T3.pet_type = 'dog'"),
+    ("pets_1", "How many students live in each city?",
+     "SELECT city_code, count(*) FROM student GROUP BY city_code"),
+    ("pets_1", "What is the maximum weight for each type of pet?",
+     "SELECT max(weight), pet_type FROM pets GROUP BY pet_type"),
+    ("pets_1", "List the last names of students who do not have any pet.",
+     "SELECT lname FROM student WHERE stu_id NOT IN (SELECT stu_id FROM has_pet)"),
+]
+
+SCHEMAS: Dict[str, List[str]] = {
+    "concert_singer": [
+        "CREATE TABLE stadium (stadium_id INTEGER PRIMARY KEY, name TEXT, location TEXT, capacity INTEGER)",
+        "CREATE TABLE singer (singer_id INTEGER PRIMARY KEY, name TEXT, country TEXT, age INTEGER)",
+        "CREATE TABLE concert (concert_id INTEGER PRIMARY KEY, concert_name TEXT, year INTEGER, "
+        "stadium_id INTEGER REFERENCES stadium (stadium_id))",
+        "CREATE TABLE singer_in_concert (concert_id INTEGER REFERENCES concert (concert_id), "
+        "singer_id INTEGER REFERENCES singer (singer_id), PRIMARY KEY (concert_id, singer_id))",
+    ],
+    "pets_1": [
+        "CREATE TABLE student (stu_id INTEGER PRIMARY KEY, lname TEXT, fname TEXT, age INTEGER, city_code TEXT)",
+        "CREATE TABLE pets (pet_id INTEGER PRIMARY KEY, pet_type TEXT, pet_age INTEGER, weight REAL)",
+        "CREATE TABLE has_pet (stu_id INTEGER REFERENCES student (stu_id), pet_id INTEGER REFERENCES pets (pet_id))",
+    ],
+}
+
+NAMES = ["Joe", "Timbaland", "Justin", "Rose", "John", "Tribal", "Linda", "Tracy", "Shiela", "Eric"]
+COUNTRIES = ["France", "Netherlands", "United States", "Germany", "Japan"]
+CITIES = ["BAL", "HKG", "WAS", "CHI", "NYC", "PIT", "LON"]
+PET_TYPES = ["cat", "dog", "fish", "bird"]
+
+
+@dataclass
+class BenchmarkArguments:
+    """
+    Arguments pertaining to the benchmark.
+    """
+
+    work_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where to write the databases and the tiny model. A temporary directory by default."}
+    )
+    model_path: Optional[str] = field(
+        default=None, metadata={"help": "Model to benchmark instead of the tiny random-weight T5."}
+    )
+    db_path: Optional[str] = field(
+        default=None,
+        metadata={"help": "Databases to benchmark against instead of the generated ones; they must contain those of QUESTIONS."},
+    )
+    rows_per_table: int = field(default=2000, metadata={
+                                "help": "Rows of every generated table."})
+    seed: int = field(default=0, metadata={
+                      "help": "Seed of the generated databases and model."})
+    max_target_length: int = field(
+        default=32, metadata={"help": "Maximum number of generated tokens."})
+    num_beams: int = field(default=2, metadata={"help": "Beam size."})
+    max_concurrency: int = field(
+        default=4, metadata={"help": "Measure the API at concurrency levels 1, 2, ... up to this one."})
+    requests_per_level: int = field(
+        default=24, metadata={"help": "Requests sent to the API per concurrency level."})
+    max_batch_size: int = field(
+        default=8, metadata={"help": "Maximum number of questions per beam search."})
+    backends: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Comma-separated inference backends to compare on accuracy and latency, e.g. fp32,int8,bf16,onnx."},
+    )
+    torch_threads: int = field(default=0, metadata={
+                               "help": "Threads used by torch. 0 to let the server decide."})
+    output: Optional[str] = field(
+        default=None, metadata={"help": "Where to write the results, as JSON."})
+    compare: Optional[str] = field(
+        default=None, metadata={"help": "Results of a previous run to compare with."})
+    cold_start_only: bool = field(
+        default=False, metadata={"help": "Internal: only measure the time to the first answer of this process."}
+    )
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """
+    Nearest-rank percentile of `values`, `q` between 0 and 100.
+    """
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[min(len(ordered), int(rank)) - 1]
+
+
+def summarize(latencies: Sequence[float], elapsed: float, errors: int = 0) -> Dict[str, float]:
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "mean_ms": 1000 * sum(latencies) / len(latencies) if latencies else float("nan"),
+        "p50_ms": 1000 * percentile(latencies, 50),
+        "p95_ms": 1000 * percentile(latencies, 95),
+        "p99_ms": 1000 * percentile(latencies, 99),
+        "throughput_rps": len(latencies) / elapsed if elapsed else float("nan"),
+    }
+
+
+def peak_rss_mb() -> float:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def make_databases(db_path: str, rows_per_table: int, seed: int = 0) -> None:
+    """
+    Writes the databases of QUESTIONS under `db_path`, with the same content for the same
+    `rows_per_table` and `seed`.
+    """
+    rng = random.Random(seed)
+    n = rows_per_table
+    rows = {
+        "stadium": [(i, f"Stadium {i}", rng.choice(CITIES), rng.randrange(1000, 100000)) for i in range(n)],
+        "singer": [(i, f"{rng.choice(NAMES)} {i}", rng.choice(COUNTRIES), rng.randrange(18, 80)) for i in range(n)],
+        "concert": [(i, f"Concert {i}", rng.randrange(2000, 2023), rng.randrange(n // 2)) for i in range(n)],
+        "singer_in_concert": sorted({(rng.randrange(n), rng.randrange(n)) for _ in range(n)}),
+        "student": [(i, f"Smith{i}", rng.choice(NAMES), rng.randrange(16, 30), rng.choice(CITIES)) for i in range(n)],
+        "pets": [(i, rng.choice(PET_TYPES), rng.randrange(1, 15), round(rng.uniform(0.1, 40), 1)) for i in range(n)],
+        "has_pet": [(rng.randrange(n // 2), rng.randrange(n)) for _ in range(n)],
+    }
+    for db_id, statements in SCHEMAS.items():
+        os.makedirs(os.path.join(db_path, db_id), exist_ok=True)
+        path = os.path.join(db_path, db_id, f"{db_id}.sqlite")
+        if os.path.exists(path):
+            os.remove(path)
+        conn = sqlite3.connect(path)
+        for statement in statements:
+            conn.execute(statement)
+            table = statement.split()[2]
+            conn.executemany(
+                f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[table][0]))})", rows[table])
+        conn.commit()
+        conn.close()
+
+
+def make_tiny_model(model_path: str, db_path: str, seed: int = 0) -> None:
+    """
+    Saves a T5 with random weights and a word-level tokenizer trained on the questions and
+    schemas of the benchmark to `model_path`, loadable with `from_pretrained`.
+    """
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers, trainers
+    from transformers import PreTrainedTokenizerFast, T5Config, T5ForConditionalGeneration
+
+    corpus = [question for _, question, _ in QUESTIONS] + \
+        [query for _, _, query in QUESTIONS]
+    for db_id in SCHEMAS:
+        conn = sqlite3.connect(os.path.join(db_path, db_id, f"{db_id}.sqlite"))
+        for table, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'"):
+            corpus.append(f"{db_id} | {table} : {sql}")
+        conn.close()
+    tokenizer = Tokenizer(models.WordLevel(unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer.train_from_iterator(corpus, trainers.WordLevelTrainer(
+        special_tokens=["<pad>", "</s>", "<unk>"]))
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, pad_token="<pad>", eos_token="</s>", unk_token="<unk>"
+    ).save_pretrained(model_path)
+
+    torch.manual_seed(seed)
+    config = T5Config(
+        vocab_size=tokenizer.get_vocab_size(),
+        d_model=64,
+        d_kv=16,
+        d_ff=128,
+        num_layers=2,
+        num_decoder_layers=2,
+        num_heads=4,
+        pad_token_id=0,
+        eos_token_id=1,
+        decoder_start_token_id=0,
+    )
+    T5ForConditionalGeneration(config).save_pretrained(model_path)
+
+
+def serving_arguments(args: BenchmarkArguments):
+    from seq2seq.utils.dataset import DataTrainingArguments
+    from serve_seq2seq import BackendArguments
+
+    backend_args = BackendArguments(
+        model_path=args.model_path,
+        db_path=args.db_path,
+        device=-1,
+        value_index=False,
+        warmup=False,
+        # every request must generate
+        result_cache_size=0,
+        max_batch_size=args.max_batch_size,
+        torch_threads=args.torch_threads,
+    )
+    data_training_args = DataTrainingArguments(
+        max_target_length=args.max_target_length,
+        num_beams=args.num_beams,
+        num_return_sequences=1,
+        schema_serialization_type="peteshaw",
+        schema_serialization_with_db_id=True,
+        schema_serialization_with_db_content=True,
+        normalize_query=True,
+    )
+    return backend_args, data_training_args
+
+
+def create_app(args: BenchmarkArguments):
+    from transformers import AutoTokenizer
+    import serve_seq2seq
+
+    backend_args, data_training_args = serving_arguments(args)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_path, use_fast=True)
+    return serve_seq2seq.create_app(backend_args, data_training_args, tokenizer)
+
+
+def ask_url(db_id: str, question: str) -> str:
+    from urllib.parse import quote
+
+    return f"/ask/{db_id}/{quote(question, safe='')}"
+
+
+def timed(fn: Callable[[], bool]) -> Tuple[float, bool]:
+    start = time.perf_counter()
+    ok = fn()
+    return time.perf_counter() - start, ok
+
+
+def load_pipeline(args: BenchmarkArguments, backend: str = "fp32"):
+    from transformers import AutoConfig, AutoTokenizer
+
+    from backends import load_model
+    from schema_cache import SchemaCache
+    from serving_pipeline import Text2SQLServingPipeline
+
+    _, data_training_args = serving_arguments(args)
+    config = AutoConfig.from_pretrained(
+        args.model_path, max_length=args.max_target_length, num_beams=args.num_beams)
+    return Text2SQLServingPipeline(
+        model=load_model(lambda model_cls: model_cls,
+                         args.model_path, config=config, backend=backend),
+        tokenizer=AutoTokenizer.from_pretrained(
+            args.model_path, use_fast=True),
+        db_path=args.db_path,
+        schemas=SchemaCache(args.db_path),
+        prefix=data_training_args.source_prefix,
+        normalize_query=data_training_args.normalize_query,
+        schema_serialization_type=data_training_args.schema_serialization_type,
+        schema_serialization_with_db_id=data_training_args.schema_serialization_with_db_id,
+        schema_serialization_with_db_content=data_training_args.schema_serialization_with_db_content,
+        device=-1,
+    )
+
+
+def generate_queries(pipe) -> Tuple[List[str], List[float], float]:
+    """
+    The query generated for every question of QUESTIONS, one at a time, with its latency,
+    and the total time taken.
+    """
+    from seq2seq.utils.pipeline import Text2SQLInput
+
+    def ask(db_id: str, question: str) -> str:
+        return pipe(inputs=Text2SQLInput(utterance=question, db_id=db_id), num_return_sequences=1)[0]["generated_text"]
+
+    for db_id, question, _ in QUESTIONS[:2]:
+        ask(db_id, question)
+    queries, latencies = [], []
+    start = time.perf_counter()
+    for db_id, question, _ in QUESTIONS:
+        question_start = time.perf_counter()
+        queries.append(ask(db_id, question))
+        latencies.append(time.perf_counter() - question_start)
+    return queries, latencies, time.perf_counter() - start
+
+
+def bench_pipeline(args: BenchmarkArguments) -> Dict[str, float]:
+    """
+    Latency of the pipeline called directly, one question at a time.
+    """
+    _, latencies, elapsed = generate_queries(load_pipeline(args))
+    return summarize(latencies, elapsed)
+
+
+def normalize_query(query: str) -> str:
+    # generated as "db_id | query" when the model was trained with target_with_db_id
+    return " ".join(query.split("|", 1)[-1].lower().split())
+
+
+def execution_match(db_path: str, db_id: str, predicted: str, gold: str) -> bool:
+    conn = sqlite3.connect(os.path.join(db_path, db_id, f"{db_id}.sqlite"))
+    try:
+        gold_rows = conn.execute(gold).fetchall()
+        try:
+            predicted_rows = conn.execute(
+                predicted.split("|", 1)[-1]).fetchall()
+        except sqlite3.Error:
+            return False
+        return sorted(map(repr, predicted_rows)) == sorted(map(repr, gold_rows))
+    finally:
+        conn.close()
+
+
+def bench_backends(args: BenchmarkArguments) -> Dict[str, Dict[str, float]]:
+    """
+    Latency and accuracy of the pipeline with every backend of `args.backends`: exact and
+    execution match against the gold queries, and agreement with the first backend.
+    """
+    results, reference = {}, None
+    for backend in args.backends.split(","):
+        try:
+            pipe = load_pipeline(args, backend)
+        except ValueError as e:
+            results[backend] = {"error": e.args[0]}
+            continue
+        queries, latencies, elapsed = generate_queries(pipe)
+        if reference is None:
+            reference = queries
+        n = len(QUESTIONS)
+        results[backend] = dict(
+            summarize(latencies, elapsed),
+            exact_match=sum(normalize_query(query) == normalize_query(gold)
+                            for query, (_, _, gold) in zip(queries, QUESTIONS)) / n,
+            execution_match=sum(execution_match(args.db_path, db_id, query, gold)
+                                for query, (db_id, _, gold) in zip(queries, QUESTIONS)) / n,
+            agreement=sum(normalize_query(query) == normalize_query(other)
+                          for query, other in zip(queries, reference)) / n,
+        )
+        del pipe
+    return results
+
+
+def bench_api(args: BenchmarkArguments) -> Dict[str, Dict[str, float]]:
+    """
+    Latency and throughput of GET /ask at every concurrency level, through a test client.
+    A model with random weights generates invalid SQL, so its answers are failed queries;
+    only unexpected errors (anything but the 500 of a failed query, or the 422 of a query
+    the guard cannot prepare) are counted.
+    """
+    from fastapi.testclient import TestClient
+
+    app = create_app(args)
+    results = {}
+    with TestClient(app, raise_server_exceptions=False) as client:
+        def ask(db_id: str, question: str) -> Callable[[], bool]:
+            return lambda: client.get(ask_url(db_id, question)).status_code in (200, 422, 500)
+
+        for db_id, question, _ in QUESTIONS[:2]:
+            ask(db_id, question)()
+        for concurrency in range(1, args.max_concurrency + 1):
+            questions = [QUESTIONS[i % len(QUESTIONS)]
+                         for i in range(args.requests_per_level)]
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                outcomes = list(executor.map(
+                    lambda q: timed(ask(q[0], q[1])), questions))
+            elapsed = time.perf_counter() - start
+            results[str(concurrency)] = summarize(
+                [latency for latency, _ in outcomes], elapsed, errors=sum(not ok for _, ok in outcomes))
+    return results
+
+
+def bench_sql(args: BenchmarkArguments, repeat: int = 10) -> Dict[str, float]:
+    """
+    Latency of executing the gold queries through the connection pool.
+    """
+    from db_files import sqlite_path
+    from db_pool import ConnectionPool
+    from execution import execute_query
+
+    pool = ConnectionPool()
+
+    def execute(db_id: str, query: str) -> Callable[[], bool]:
+        def run() -> bool:
+            with pool.connection(sqlite_path(args.db_path, db_id)) as conn:
+                execute_query(conn, query, max_rows=1000)
+            return True
+        return run
+
+    start = time.perf_counter()
+    latencies = [timed(execute(db_id, query))[0]
+                 for _ in range(repeat) for db_id, _, query in QUESTIONS]
+    elapsed = time.perf_counter() - start
+    pool.close()
+    return summarize(latencies, elapsed)
+
+
+def cold_start(args: BenchmarkArguments) -> Dict[str, float]:
+    """
+    Time for a fresh process to import the server, load the model and answer a question.
+    """
+    start = time.perf_counter()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--cold_start_only", "--model_path", args.model_path,
+         "--db_path", args.db_path, "--max_target_length", str(args.max_target_length),
+         "--num_beams", str(args.num_beams)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True,
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["process_seconds"] = time.perf_counter() - start
+    return result
+
+
+def first_answer(args: BenchmarkArguments) -> Dict[str, float]:
+    start = time.perf_counter()
+    from fastapi.testclient import TestClient
+    import serve_seq2seq  # noqa: F401
+    imported = time.perf_counter()
+    app = create_app(args)
+    created = time.perf_counter()
+    with TestClient(app, raise_server_exceptions=False) as client:
+        db_id, question, _ = QUESTIONS[0]
+        client.get(ask_url(db_id, question))
+    answered = time.perf_counter()
+    return {
+        "import_seconds": imported - start,
+        "create_app_seconds": created - imported,
+        "first_request_seconds": answered - created,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def compare(previous: dict, current: dict, prefix: str = "") -> List[str]:
+    lines = []
+    for key, value in current.items():
+        old = previous.get(key) if isinstance(previous, dict) else None
+        if isinstance(value, dict):
+            lines.extend(compare(old or {}, value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+            lines.append(
+                f"{prefix}{key}: {old:.2f} -> {value:.2f} ({100 * (value - old) / old:+.1f}%)")
+    return lines
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    # never reach out to the hub
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    os.environ.setdefault("HF_DATASETS_OFFLINE", "1")
+    from transformers.hf_argparser import HfArgumentParser
+
+    args: BenchmarkArguments
+    args, = HfArgumentParser(BenchmarkArguments).parse_args_into_dataclasses()
+    if args.cold_start_only:
+        print(json.dumps(first_answer(args)))
+        return
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="ez-picard-benchmark-")
+    if args.db_path is None:
+        args.db_path = os.path.join(work_dir, "database")
+        make_databases(args.db_path, args.rows_per_table, args.seed)
+    if args.model_path is None:
+        args.model_path = os.path.join(work_dir, "model")
+        make_tiny_model(args.model_path, args.db_path, args.seed)
+
+    import torch
+
+    results = {"cold_start": cold_start(args)}
+    results["sql"] = bench_sql(args)
+    results["pipeline"] = bench_pipeline(args)
+    results["api"] = bench_api(args)
+    if args.backends:
+        results["backends"] = bench_backends(args)
+    results["peak_rss_mb"] = peak_rss_mb()
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "arguments": asdict(args),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.compare is not None:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        print(f"Compared with {previous.get('commit')}:")
+        for line in compare(previous["results"], results):
+            print(f"  {line}")
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
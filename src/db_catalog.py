@@ -0,0 +1,238 @@
+import collections
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+from dataclasses import asdict, dataclass
+from typing import Callable, Dict, List, Optional
+
+from db_files import Fingerprint, fingerprint, sqlite_path
+
+logger = logging.getLogger(__name__)
+
+USAGE_FILE = ".catalog_usage.json"
+
+
+@dataclass
+class CatalogEntry:
+    db_id: str
+    path: str
+    fingerprint: Fingerprint
+    size: int
+    mtime: float
+    tables: int
+    columns: int
+    sha256: str
+
+    def to_dict(self) -> dict:
+        entry = asdict(self)
+        del entry["path"], entry["fingerprint"]
+        return entry
+
+
+def _sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    try:
+        # written by store_database after the file itself
+        if os.stat(f"{path}.sha256").st_mtime >= os.stat(path).st_mtime:
+            with open(f"{path}.sha256") as f:
+                return f.read().strip()
+    except FileNotFoundError:
+        pass
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_entry(db_path: str, db_id: str) -> CatalogEntry:
+    """
+    Describes the database `db_id`, raising OperationalError if it is missing or unreadable.
+    """
+    path = sqlite_path(db_path, db_id)
+    current = fingerprint(path)
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables, columns = conn.execute(
+            "SELECT count(DISTINCT m.name), count(c.name) FROM sqlite_master m "
+            "LEFT JOIN pragma_table_info(m.name) c WHERE m.type = 'table' AND m.name NOT LIKE 'sqlite_%'"
+        ).fetchone()
+    except sqlite3.DatabaseError as e:
+        raise sqlite3.OperationalError(f"unable to read {path}: {e}")
+    finally:
+        conn.close()
+    return CatalogEntry(
+        db_id=db_id,
+        path=path,
+        fingerprint=current,
+        size=current[2],
+        mtime=current[1] / 1e9,
+        tables=tables,
+        columns=columns,
+        sha256=_sha256(path),
+    )
+
+
+class DatabaseCatalog:
+    """
+    Describes every database under `db_path` (size, modification time, number of tables and
+    columns, SHA-256) from memory, so that requests neither list the directory nor reach
+    the model for unknown databases.
+
+    `refresh` stats every database and only reads the new and changed ones again; once
+    `start` is called, it runs every `refresh_interval` seconds on a background thread and
+    calls `on_change(db_id)` for every database that was added or changed. Only metadata is
+    kept, so memory grows with the number of databases, not with their size.
+
+    Lookups of every database are counted (`record_use`) so that the `most_used` ones can be
+    warmed up. The counts are saved to `db_path/.catalog_usage.json` on every refresh and
+    read back at startup; with several workers, the last one to save wins.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        refresh_interval: float = 30.0,
+        on_change: Optional[Callable[[str], None]] = None,
+    ):
+        self.db_path = db_path
+        self.refresh_interval = refresh_interval
+        self.on_change = on_change
+        self._entries: Dict[str, CatalogEntry] = {}
+        self._usage: "collections.Counter[str]" = collections.Counter(
+            self._read_usage())
+        self._saved_usage = dict(self._usage)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # started on first use, so that the catalog can be created before forking workers
+        self._thread: Optional[threading.Thread] = None
+
+    def _db_ids(self) -> List[str]:
+        try:
+            names = os.listdir(self.db_path)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names
+                      if os.path.isfile(sqlite_path(self.db_path, name)))
+
+    def _read(self, db_id: str) -> Optional[CatalogEntry]:
+        try:
+            return read_entry(self.db_path, db_id)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Could not describe the database {db_id}: {e}")
+            return None
+
+    def refresh(self) -> List[str]:
+        """
+        Brings the catalog up to date with the disk, returning the db_ids added or changed.
+        """
+        changed = []
+        db_ids = self._db_ids()
+        for db_id in db_ids:
+            entry = self._entries.get(db_id)
+            try:
+                if entry is not None and entry.fingerprint == fingerprint(entry.path):
+                    continue
+            except sqlite3.OperationalError:
+                # removed meanwhile
+                continue
+            entry = self._read(db_id)
+            if entry is not None:
+                with self._lock:
+                    self._entries[db_id] = entry
+                changed.append(db_id)
+        with self._lock:
+            for db_id in set(self._entries) - set(db_ids):
+                del self._entries[db_id]
+        return changed
+
+    def get(self, db_id: str) -> Optional[CatalogEntry]:
+        """
+        The entry of `db_id`, read from disk when it was added since the last refresh (e.g.
+        uploaded or converted by another worker), or None if there is no such database.
+        """
+        entry = self._entries.get(db_id)
+        if entry is None and db_id and not db_id.startswith(".") and os.sep not in db_id \
+                and os.path.isfile(sqlite_path(self.db_path, db_id)):
+            entry = self.update(db_id)
+        return entry
+
+    def update(self, db_id: str) -> Optional[CatalogEntry]:
+        entry = self._read(db_id)
+        with self._lock:
+            if entry is None:
+                self._entries.pop(db_id, None)
+            else:
+                self._entries[db_id] = entry
+        return entry
+
+    def entries(self) -> List[CatalogEntry]:
+        with self._lock:
+            return sorted(self._entries.values(), key=lambda entry: entry.db_id)
+
+    def record_use(self, db_id: str) -> None:
+        with self._lock:
+            # only known databases, the counts stay as small as the catalog
+            if db_id in self._entries:
+                self._usage[db_id] += 1
+
+    def most_used(self, n: int) -> List[str]:
+        """
+        Up to `n` db_ids, the most used first, completed by name when too few were used.
+        """
+        with self._lock:
+            used = [db_id for db_id, _ in self._usage.most_common()
+                    if db_id in self._entries]
+            unused = sorted(set(self._entries) - set(used))
+        return (used + unused)[:n]
+
+    def _read_usage(self) -> Dict[str, int]:
+        try:
+            with open(os.path.join(self.db_path, USAGE_FILE)) as f:
+                return {db_id: int(count) for db_id, count in json.load(f).items()}
+        except (OSError, ValueError, AttributeError):
+            return {}
+
+    def save_usage(self) -> None:
+        with self._lock:
+            usage = dict(self._usage)
+        if usage == self._saved_usage:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.db_path, suffix=".usage")
+            with os.fdopen(fd, "w") as f:
+                json.dump(usage, f)
+            os.replace(tmp, os.path.join(self.db_path, USAGE_FILE))
+            self._saved_usage = usage
+        except OSError as e:
+            logger.warning(f"Could not save the use of the databases: {e}")
+
+    def start(self) -> None:
+        if self._thread is None and self.refresh_interval > 0:
+            self._thread = threading.Thread(
+                target=self._run, name="db-catalog", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.save_usage()
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.refresh_interval):
+            try:
+                changed = self.refresh()
+                self.save_usage()
+            except Exception:
+                logger.exception("Refreshing the database catalog failed")
+                continue
+            if self.on_change is not None:
+                for db_id in changed:
+                    try:
+                        self.on_change(db_id)
+                    except Exception:
+                        logger.exception(f"on_change failed for {db_id}")
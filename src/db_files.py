@@ -0,0 +1,109 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+from sqlite3 import OperationalError
+from typing import BinaryIO, NamedTuple, Optional, Tuple
+
+Fingerprint = Tuple[int, int, int]
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def sqlite_path(db_path: str, db_id: str) -> str:
+    return f"{db_path}/{db_id}/{db_id}.sqlite"
+
+
+def fingerprint(path: str) -> Fingerprint:
+    """
+    Identifies a version of a database file by its inode, modification time and size,
+    so that both in-place writes and replacements of the file are noticed.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise OperationalError(f"unable to open database file: {path}")
+    return st.st_ino, st.st_mtime_ns, st.st_size
+
+
+class StoredDatabase(NamedTuple):
+    path: str
+    sha256: str
+    size: int
+    changed: bool
+
+
+def _stored_hash(path: str, chunk_size: int) -> Optional[str]:
+    try:
+        with open(f"{path}.sha256") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    if not os.path.exists(path):
+        return None
+    # stored before hashes were recorded
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def validate_sqlite(path: str) -> None:
+    """
+    Raises ValueError unless `path` is a readable, uncorrupted SQLite database.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(SQLITE_HEADER)) != SQLITE_HEADER:
+            raise ValueError("not a SQLite database")
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            problem = conn.execute("PRAGMA quick_check(1)").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"invalid SQLite database: {e}")
+    if problem != "ok":
+        raise ValueError(f"corrupted SQLite database: {problem}")
+
+
+def store_database(source: BinaryIO, path: str, chunk_size: int = 1 << 20) -> StoredDatabase:
+    """
+    Copies `source` to `path` in chunks of `chunk_size` bytes, through a temporary file in
+    the same directory that is hashed while it is written, validated, and then renamed over
+    `path`, so that readers only ever see a complete database.
+
+    Nothing is replaced when the content has the same SHA-256 as the stored database, so the
+    file keeps its fingerprint and everything cached for it. The hash is kept in
+    `{path}.sha256`.
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        sha256 = digest.hexdigest()
+        if sha256 == _stored_hash(path, chunk_size):
+            return StoredDatabase(path, sha256, size, changed=False)
+        validate_sqlite(tmp)
+        os.chmod(tmp, 0o644)
+        # never leave the hash of the previous content behind
+        if os.path.exists(f"{path}.sha256"):
+            os.remove(f"{path}.sha256")
+        os.replace(tmp, path)
+        with open(f"{path}.sha256", "w") as f:
+            f.write(sha256)
+        return StoredDatabase(path, sha256, size, changed=True)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
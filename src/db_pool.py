@@ -0,0 +1,101 @@
+import logging
+import threading
+from contextlib import contextmanager
+from sqlite3 import Connection, connect
+from typing import Dict, Iterator, List
+from urllib.parse import quote
+
+from db_files import Fingerprint, fingerprint
+
+logger = logging.getLogger(__name__)
+
+
+class _DatabasePool:
+    def __init__(self, fingerprint: Fingerprint):
+        self.fingerprint = fingerprint
+        self.idle: List[Connection] = []
+        self.closed = False
+
+
+class ConnectionPool:
+    """
+    Pools read-only SQLite connections per database file, for use across requests and threads.
+
+    Connections are opened with `mode=ro` (and `immutable=1` when the files are never written
+    in place) and `query_only`, with a large page cache and memory-mapped I/O. A pool is
+    dropped as soon as its file changes on disk or `invalidate` is called; connections checked
+    out at that time are closed when they are given back.
+    """
+
+    def __init__(
+        self,
+        max_idle: int = 4,
+        mmap_size: int = 256 << 20,
+        cache_size_kib: int = 64 << 10,
+        immutable: bool = False,
+    ):
+        self.max_idle = max_idle
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.immutable = immutable
+        self._pools: Dict[str, _DatabasePool] = {}
+        self._lock = threading.Lock()
+
+    def _connect(self, path: str) -> Connection:
+        uri = f"file:{quote(path)}?mode=ro"
+        if self.immutable:
+            uri += "&immutable=1"
+        conn = connect(uri, uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute(f"PRAGMA cache_size = {-int(self.cache_size_kib)}")
+        return conn
+
+    def _pool(self, path: str) -> _DatabasePool:
+        current = fingerprint(path)
+        with self._lock:
+            pool = self._pools.get(path)
+            if pool is not None and pool.fingerprint == current:
+                return pool
+            if pool is not None:
+                self._close(pool)
+            pool = self._pools[path] = _DatabasePool(current)
+            return pool
+
+    @contextmanager
+    def connection(self, path: str) -> Iterator[Connection]:
+        pool = self._pool(path)
+        with self._lock:
+            conn = pool.idle.pop() if pool.idle else None
+        if conn is None:
+            conn = self._connect(path)
+        try:
+            yield conn
+        finally:
+            self._release(pool, conn)
+
+    def _release(self, pool: _DatabasePool, conn: Connection) -> None:
+        conn.set_progress_handler(None, 0)
+        with self._lock:
+            if not pool.closed and len(pool.idle) < self.max_idle:
+                pool.idle.append(conn)
+                return
+        conn.close()
+
+    def _close(self, pool: _DatabasePool) -> None:
+        pool.closed = True
+        for conn in pool.idle:
+            conn.close()
+        pool.idle.clear()
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            pool = self._pools.pop(path, None)
+            if pool is not None:
+                self._close(pool)
+
+    def close(self) -> None:
+        with self._lock:
+            for pool in self._pools.values():
+                self._close(pool)
+            self._pools.clear()
@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from sqlite3 import Connection, Cursor, OperationalError
+from typing import Iterator, List, Optional
+
+
+class QueryTimeout(OperationalError):
+    pass
+
+
+class QueryCancelled(OperationalError):
+    pass
+
+
+@dataclass
+class ExecutionResult:
+    rows: List[tuple]
+    truncated: bool
+
+
+@contextmanager
+def deadline(
+    conn: Connection, timeout: Optional[float], steps: int = 1000, cancelled: Optional[threading.Event] = None
+) -> Iterator[None]:
+    """
+    Interrupts statements running on `conn` for longer than `timeout` seconds, or once
+    `cancelled` is set, checking every `steps` virtual machine instructions. Raises
+    `QueryTimeout` or `QueryCancelled` accordingly.
+    """
+    if not timeout and cancelled is None:
+        yield
+        return
+    end = time.monotonic() + timeout if timeout else None
+
+    def interrupt() -> bool:
+        return (end is not None and time.monotonic() > end) or (cancelled is not None and cancelled.is_set())
+
+    conn.set_progress_handler(interrupt, steps)
+    try:
+        yield
+    except OperationalError as e:
+        if "interrupted" in str(e):
+            if cancelled is not None and cancelled.is_set():
+                raise QueryCancelled("query cancelled")
+            if end is not None and time.monotonic() > end:
+                raise QueryTimeout(f"query timed out after {timeout:g}s")
+        raise
+    finally:
+        conn.set_progress_handler(None, 0)
+
+
+def _skip(cursor: Cursor, offset: int, chunk_size: int = 1000) -> None:
+    while offset > 0:
+        skipped = len(cursor.fetchmany(min(offset, chunk_size)))
+        if not skipped:
+            break
+        offset -= skipped
+
+
+def execute_query(
+    conn: Connection,
+    query: str,
+    max_rows: int,
+    offset: int = 0,
+    timeout: Optional[float] = None,
+    cancelled: Optional[threading.Event] = None,
+) -> ExecutionResult:
+    """
+    Returns at most `max_rows` rows of `query`, starting at row `offset`, without
+    materializing the rest of the result.
+    """
+    with deadline(conn, timeout, cancelled=cancelled):
+        cursor = conn.execute(query)
+        try:
+            _skip(cursor, offset)
+            rows = cursor.fetchmany(max_rows + 1)
+        finally:
+            cursor.close()
+    return ExecutionResult(rows=rows[:max_rows], truncated=len(rows) > max_rows)
+
+
+def iter_query(
+    conn: Connection, query: str, max_rows: int, timeout: Optional[float] = None, chunk_size: int = 256
+) -> Iterator[tuple]:
+    """
+    Yields at most `max_rows` rows of `query`, fetching them `chunk_size` at a time.
+    """
+    with deadline(conn, timeout):
+        cursor = conn.execute(query)
+        try:
+            while max_rows > 0:
+                rows = cursor.fetchmany(min(chunk_size, max_rows))
+                if not rows:
+                    break
+                max_rows -= len(rows)
+                yield from rows
+        finally:
+            cursor.close()
+
+
+class ResultCursors:
+    """
+    Opaque pagination cursors, signed so that clients can only page through queries the
+    server generated.
+    """
+
+    def __init__(self, secret: Optional[bytes] = None):
+        self.secret = secret or os.urandom(32)
+
+    def _sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:16]
+
+    def encode(self, path: str, query: str, offset: int, limit: int) -> str:
+        payload = json.dumps(
+            {"path": path, "query": query, "offset": offset, "limit": limit}).encode()
+        return base64.urlsafe_b64encode(self._sign(payload) + payload).decode()
+
+    def decode(self, cursor: str) -> dict:
+        try:
+            raw = base64.urlsafe_b64decode(cursor.encode())
+        except ValueError:
+            raise ValueError("malformed cursor")
+        signature, payload = raw[:16], raw[16:]
+        if not hmac.compare_digest(signature, self._sign(payload)):
+            raise ValueError("invalid cursor")
+        return json.loads(payload)
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Executor, Future
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class Overloaded(Exception):
+    pass
+
+
+def physical_cores() -> int:
+    """
+    Number of physical cores available to the process, falling back to the number of
+    logical CPUs when /proc/cpuinfo cannot be read.
+    """
+    try:
+        available = os.sched_getaffinity(0)
+    except AttributeError:
+        available = set(range(os.cpu_count() or 1))
+    try:
+        cores, processor, physical_id = set(), None, "0"
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                key, value = key.strip(), value.strip()
+                if key == "processor":
+                    processor = int(value)
+                elif key == "physical id":
+                    physical_id = value
+                elif key == "core id" and processor in available:
+                    cores.add((physical_id, value))
+        if cores:
+            return len(cores)
+    except (OSError, ValueError):
+        pass
+    return len(available)
+
+
+class BoundedExecutor:
+    """
+    Wraps an executor and refuses new work with `Overloaded` once `max_pending` tasks are
+    queued or running, so that latency cannot grow without bound under load.
+    """
+
+    def __init__(self, executor: Executor, max_pending: int):
+        self.executor = executor
+        self.max_pending = max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def submit(self, fn: Callable[..., T], *args, **kwargs) -> "Future[T]":
+        with self._lock:
+            if self.max_pending and self._pending >= self.max_pending:
+                raise Overloaded(
+                    f"{self._pending} tasks are already pending")
+            self._pending += 1
+        try:
+            future = self.executor.submit(fn, *args, **kwargs)
+        except BaseException:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _future) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    async def run(self, fn: Callable[..., T], *args, **kwargs) -> T:
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+
+async def iterate_in(executor: BoundedExecutor, iterator: Iterator[T]) -> AsyncIterator[T]:
+    """
+    Consumes a blocking iterator on `executor`, one item at a time.
+    """
+    done = object()
+    while True:
+        item = await executor.run(next, iterator, done)
+        if item is done:
+            break
+        yield item
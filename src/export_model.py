@@ -0,0 +1,88 @@
+import importlib.util
+import inspect
+import json
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Optional
+
+# Exports a model, its tokenizer and its config to a local directory that
+# serve_seq2seq.py loads with --artifact_path, without resolving anything through the hub:
+#
+#     python export_model.py --model_path tscholak/1zha5ono --output_dir /artifacts/1zha5ono
+
+MANIFEST = "ez_picard_artifact.json"
+
+
+@dataclass
+class ExportArguments:
+    """
+    Arguments pertaining to the export of a model.
+    """
+
+    model_path: str = field(metadata={
+                            "help": "The model to export, from the hub or a local directory."})
+    output_dir: str = field(metadata={
+                            "help": "Where to write the artifact."})
+    cache_dir: Optional[str] = field(
+        default=None, metadata={"help": "Where to cache pretrained models and data."})
+    safetensors: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether to write the weights as safetensors, which are memory-mapped when loaded, if supported."},
+    )
+
+
+def read_manifest(artifact_path: str) -> dict:
+    """
+    The manifest of an artifact written by `export_model`, raising ValueError if there is none.
+    """
+    try:
+        with open(os.path.join(artifact_path, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        raise ValueError(
+            f"{artifact_path} is not a model exported by export_model.py")
+
+
+def export_model(model_path: str, output_dir: str, cache_dir: Optional[str] = None, safetensors: bool = True) -> dict:
+    from transformers import __version__ as transformers_version
+    from transformers.models.auto import AutoConfig, AutoModelForSeq2SeqLM, AutoTokenizer
+
+    config = AutoConfig.from_pretrained(model_path, cache_dir=cache_dir)
+    tokenizer = AutoTokenizer.from_pretrained(
+        model_path, cache_dir=cache_dir, use_fast=True)
+    model = AutoModelForSeq2SeqLM.from_pretrained(
+        model_path, config=config, cache_dir=cache_dir)
+
+    # older versions of transformers can neither write nor read safetensors
+    safetensors = safetensors and importlib.util.find_spec("safetensors") is not None \
+        and "safe_serialization" in inspect.signature(model.save_pretrained).parameters
+    os.makedirs(output_dir, exist_ok=True)
+    if safetensors:
+        model.save_pretrained(output_dir, safe_serialization=True)
+    else:
+        model.save_pretrained(output_dir)
+    tokenizer.save_pretrained(output_dir)
+    manifest = {
+        "model_path": model_path,
+        "transformers": transformers_version,
+        "weights": "safetensors" if safetensors else "pytorch",
+    }
+    with open(os.path.join(output_dir, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def main():
+    from transformers.hf_argparser import HfArgumentParser
+
+    args: ExportArguments
+    args, = HfArgumentParser(ExportArguments).parse_args_into_dataclasses()
+    manifest = export_model(args.model_path, args.output_dir,
+                            cache_dir=args.cache_dir, safetensors=args.safetensors)
+    json.dump(manifest, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
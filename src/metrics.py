@@ -0,0 +1,217 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+Samples = Union[float, Dict[Labels, float]]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Labels = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"] + [
+            f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in values
+        ]
+
+
+class Histogram:
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # labels -> (count per bucket, sum, count)
+        self._values: Dict[Labels, Tuple[List[int], float, int]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _labels(labels)
+        with self._lock:
+            counts, total, count = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0))
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(counts):
+                counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total, count))
+                            for labels, (counts, total, count) in self._values.items())
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(
+                    f"{self.name}_bucket{_format_labels(labels, (('le', _format_value(bound)),))} {cumulative}")
+            lines.append(
+                f"{self.name}_bucket{_format_labels(labels, (('le', '+Inf'),))} {count}")
+            lines.append(
+                f"{self.name}_sum{_format_labels(labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Collected:
+    """
+    Gauge or counter whose samples are read from `collect` at scrape time, which returns
+    either a single value or values keyed by labels (see `labels`).
+    """
+
+    def __init__(self, name: str, help: str, type: str, collect: Callable[[], Samples]):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.collect = collect
+
+    def render(self) -> List[str]:
+        samples = self.collect()
+        if not isinstance(samples, dict):
+            samples = {(): samples}
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + [
+            f"{self.name}{_format_labels(labels)} {_format_value(value)}" for labels, value in sorted(samples.items())
+        ]
+
+
+def labels(**labels) -> Labels:
+    return _labels(labels)
+
+
+class MetricsRegistry:
+    """
+    Minimal registry of metrics rendered in the Prometheus text exposition format.
+
+    Metrics live in the memory of the process: with several workers, every scrape only
+    reports the worker that served it.
+    """
+
+    def __init__(self, namespace: str = ""):
+        self.namespace = namespace
+        self._metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def _name(self, name: str) -> str:
+        return f"{self.namespace}_{name}" if self.namespace else name
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(self._name(name), help))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self._name(name), help, buckets))
+
+    def gauge(self, name: str, help: str, collect: Callable[[], Samples]) -> Collected:
+        return self._register(Collected(self._name(name), help, "gauge", collect))
+
+    def collected_counter(self, name: str, help: str, collect: Callable[[], Samples]) -> Collected:
+        return self._register(Collected(self._name(name), help, "counter", collect))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Stage durations of the request being served, for the Server-Timing header
+_request_timings: "contextvars.ContextVar[Optional[Dict[str, float]]]" = contextvars.ContextVar(
+    "request_timings", default=None)
+
+
+@contextmanager
+def request_timings() -> Iterator[Dict[str, float]]:
+    """
+    Collects the durations passed to `record_timing` while serving a request, including
+    from tasks started by it, into the yielded dict.
+    """
+    timings: Dict[str, float] = {}
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def record_timing(stage: str, seconds: float) -> None:
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+class Phases:
+    """
+    Durations of the named phases of a process, e.g. its startup, in the order they ran.
+    """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    def record(self, name: str, seconds: float) -> None:
+        self.seconds[name] = seconds
+        logger.warning(f"{name} took {seconds:.2f}s")
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
@@ -0,0 +1,116 @@
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class ModelKey(NamedTuple):
+    model_path: str
+    device: int
+    generation_config: Tuple
+
+
+def pipeline_size(pipe) -> int:
+    """
+    Number of bytes taken by the weights and buffers of the pipeline's model, including
+    dynamically quantized ones, which are not parameters. Models that are not torch modules
+    (e.g. ONNX Runtime sessions) weigh nothing.
+    """
+    state_dict = getattr(pipe.model, "state_dict", None)
+    if state_dict is None:
+        return 0
+    seen, size = set(), 0
+    stack = list(state_dict(keep_vars=True).values())
+    while stack:
+        value = stack.pop()
+        if isinstance(value, (tuple, list)):
+            stack.extend(value)
+        elif hasattr(value, "element_size"):
+            # tied weights are counted once
+            if value.data_ptr() not in seen:
+                seen.add(value.data_ptr())
+                size += value.numel() * value.element_size()
+    return size
+
+
+class ModelRegistry:
+    """
+    Keeps loaded pipelines resident, keyed by `ModelKey`.
+
+    Pipelines are loaded lazily the first time their key is requested. Once the summed size
+    of the resident models exceeds `memory_budget` bytes, the least recently used ones are
+    evicted. Pinned entries count towards the budget but are never evicted.
+    """
+
+    def __init__(self, memory_budget: int, weigh: Callable[[Any], int] = pipeline_size):
+        self.memory_budget = memory_budget
+        self.weigh = weigh
+        self._entries: "OrderedDict[ModelKey, Tuple[Any, int]]" = OrderedDict()
+        self._pinned = set()
+        self._load_locks: Dict[ModelKey, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key: ModelKey) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(size for _, size in self._entries.values())
+
+    def add(self, key: ModelKey, pipe, pinned: bool = False) -> None:
+        size = self.weigh(pipe)
+        with self._lock:
+            self._entries[key] = (pipe, size)
+            self._entries.move_to_end(key)
+            if pinned:
+                self._pinned.add(key)
+            self._evict()
+
+    def get(self, key: ModelKey, load: Callable[[], Any]):
+        """
+        Returns the pipeline for `key`, calling `load()` to build it if it is not resident.
+        Concurrent requests for the same missing key wait for a single load.
+        """
+        with self._lock:
+            pipe = self._lookup(key)
+            if pipe is not None:
+                return pipe
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+        with load_lock:
+            with self._lock:
+                pipe = self._lookup(key)
+                if pipe is not None:
+                    return pipe
+            logger.warning(f"Loading {key.model_path} on device {key.device}")
+            pipe = load()
+            self.add(key, pipe)
+            with self._lock:
+                self._load_locks.pop(key, None)
+        return pipe
+
+    def _lookup(self, key: ModelKey):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def _evict(self) -> None:
+        total = sum(size for _, size in self._entries.values())
+        # the most recently used entry is kept even if it alone exceeds the budget
+        for key in list(self._entries)[:-1]:
+            if total <= self.memory_budget:
+                break
+            if key in self._pinned:
+                continue
+            _, size = self._entries.pop(key)
+            total -= size
+            logger.warning(f"Evicted {key.model_path} on device {key.device} ({size >> 20} MiB)")
@@ -0,0 +1,157 @@
+import re
+import threading
+from dataclasses import dataclass, field
+from sqlite3 import Connection, DatabaseError, OperationalError
+from typing import Dict, List, Optional, Tuple
+
+from db_files import fingerprint
+
+LOOP = re.compile(r"^(SCAN|SEARCH) (?:TABLE )?(\S+)(?: AS (\S+))?(.*)$")
+LIMIT = re.compile(r"\blimit\b", re.IGNORECASE)
+AGGREGATE = re.compile(
+    r"\b(count|sum|avg|min|max|total|group_concat)\s*\(", re.IGNORECASE)
+
+
+class QueryRejected(OperationalError):
+    pass
+
+
+@dataclass
+class QueryCost:
+    """
+    Estimate of the rows a query visits, from its plan: the loops of every SELECT multiply,
+    SELECTs (subqueries, compound parts) add up.
+    """
+
+    rows: float = 0.0
+    reasons: List[str] = field(default_factory=list)
+    # the plan sorts, groups or deduplicates, which consumes every row before the first one
+    blocking: bool = False
+
+
+class QueryGuard:
+    """
+    Checks generated queries against their `EXPLAIN QUERY PLAN` before running them.
+
+    Queries the plan estimates to visit more than `max_cost` rows (full scans of large
+    tables, cartesian products) are rewritten with a LIMIT when that bounds their work, i.e.
+    when they have none and nothing in the plan consumes the whole result first; they are
+    rejected with `QueryRejected` otherwise. Queries that SQLite cannot prepare are rejected
+    too. An index lookup is assumed to visit `rows_per_lookup` rows.
+
+    Table sizes come from `sqlite_stat1` when the database was analyzed, and are counted up
+    to `max_cost + 1` rows otherwise. They are remembered per version of the database file.
+    """
+
+    def __init__(self, max_cost: float = 1e7, rows_per_lookup: float = 10):
+        self.max_cost = max_cost
+        self.rows_per_lookup = rows_per_lookup
+        # (database file, its fingerprint, table) -> rows
+        self._rows: Dict[Tuple[str, tuple, str], float] = {}
+        self._lock = threading.Lock()
+
+    def _count_rows(self, conn: Connection, table: str) -> float:
+        try:
+            stat = conn.execute(
+                "SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,)).fetchone()
+        except DatabaseError:
+            # never analyzed
+            stat = None
+        if stat is not None and stat[0]:
+            return float(stat[0].split()[0])
+        # bounded, anything above max_cost is too much anyway
+        return float(conn.execute(
+            f'SELECT count(*) FROM (SELECT 1 FROM "{table}" LIMIT ?)', (int(self.max_cost) + 1,)).fetchone()[0])
+
+    def _table_rows(self, conn: Connection, table: str, cache: Dict[str, float]) -> float:
+        if table in cache:
+            return cache[table]
+        key = None
+        file = conn.execute("PRAGMA database_list").fetchone()[2]
+        if file:
+            try:
+                key = (file, fingerprint(file), table)
+            except OperationalError:
+                pass
+        with self._lock:
+            rows = self._rows.get(key) if key is not None else None
+        if rows is None:
+            rows = self._count_rows(conn, table)
+            if key is not None:
+                with self._lock:
+                    # forget previous versions of the file
+                    for stale in [stale for stale in self._rows if stale[0] == file and stale[1] != key[1]]:
+                        del self._rows[stale]
+                    self._rows[key] = rows
+        cache[table] = rows
+        return rows
+
+    @staticmethod
+    def _resolve(query: str, name: str, tables: Dict[str, str]) -> Optional[str]:
+        """
+        The table `name` refers to: recent versions of SQLite only name the alias in plans.
+        """
+        if name.lower() in tables:
+            return tables[name.lower()]
+        for match in re.finditer(rf'([\w"`\[\]]+)\s+(?:as\s+)?{re.escape(name)}\b', query, re.IGNORECASE):
+            table = match.group(1).strip('"`[]').lower()
+            if table in tables:
+                return tables[table]
+        return None
+
+    def cost(self, conn: Connection, query: str) -> QueryCost:
+        try:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        except DatabaseError as e:
+            raise QueryRejected(f"invalid query: {e}")
+        tables = {name.lower(): name for name, in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'")}
+        cost, table_rows = QueryCost(), {}
+        selects: Dict[int, List[float]] = {}
+        scans: Dict[int, List[str]] = {}
+        for _, parent, _, detail in plan:
+            if "TEMP B-TREE" in detail:
+                cost.blocking = True
+            match = LOOP.match(detail)
+            if match is None:
+                continue
+            kind, name, _, rest = match.groups()
+            table = self._resolve(query, name, tables)
+            if table is None:
+                # subqueries, constant rows, ...
+                continue
+            if kind == "SCAN":
+                rows = self._table_rows(conn, table, table_rows)
+                scans.setdefault(parent, []).append(table)
+                if rows > self.max_cost:
+                    cost.reasons.append(
+                        f"full scan of {table} (~{rows:.0f} rows)")
+            elif "INTEGER PRIMARY KEY" in rest or "rowid=" in rest:
+                rows = 1.0
+            else:
+                rows = self.rows_per_lookup
+            selects.setdefault(parent, []).append(max(rows, 1.0))
+        for scanned in scans.values():
+            if len(scanned) > 1:
+                cost.reasons.append(
+                    f"cartesian product of {', '.join(scanned)}")
+        for loops in selects.values():
+            product = 1.0
+            for rows in loops:
+                product *= rows
+            cost.rows += product
+        return cost
+
+    def check(self, conn: Connection, query: str, max_rows: int) -> str:
+        """
+        The query to run instead of `query`, which fetches at most `max_rows` rows: the query
+        itself or its rewrite with a LIMIT. Raises `QueryRejected`.
+        """
+        cost = self.cost(conn, query)
+        if cost.rows <= self.max_cost:
+            return query
+        if not cost.blocking and not LIMIT.search(query) and not AGGREGATE.search(query):
+            return f"{query.rstrip().rstrip(';')} LIMIT {max_rows}"
+        reasons = "; ".join(cost.reasons) or "too many rows to visit"
+        raise QueryRejected(
+            f"query rejected, it would visit ~{cost.rows:.0f} rows (at most {self.max_cost:.0f}): {reasons}")
@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from db_files import Fingerprint
+
+
+class ResultKey(NamedTuple):
+    path: str
+    question: str
+    model_path: str
+    generation_config: Tuple
+
+
+def normalize_question(question: str) -> str:
+    """
+    Collapses whitespace only: casing and punctuation can change what the model generates.
+    """
+    return " ".join(question.split())
+
+
+class ResultCache:
+    """
+    LRU cache of generation results with a time to live.
+
+    Every entry remembers the fingerprint of the database file it was computed from and
+    is discarded as soon as the file changes. Hits, misses, expirations, invalidations
+    and evictions are counted to help sizing it.
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0, clock: Callable[[], float] = time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self._entries: "OrderedDict[ResultKey, Tuple[Fingerprint, float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.expirations = self.invalidations = self.evictions = 0
+
+    def get(self, key: ResultKey, fingerprint: Fingerprint) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            entry_fingerprint, expires, value = entry
+            if entry_fingerprint != fingerprint:
+                del self._entries[key]
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            if expires < self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: ResultKey, fingerprint: Fingerprint, value: Any) -> None:
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (fingerprint, self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, path: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key.path == path]:
+                del self._entries[key]
+                self.invalidations += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,218 @@
+import logging
+import random
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from seq2seq.utils.bridge_content_encoder import get_column_picklist, get_database_matches
+from seq2seq.utils.pipeline import get_schema
+
+from db_files import Fingerprint, fingerprint, sqlite_path
+from value_index import ValueIndex, ValueIndexBuilder
+
+logger = logging.getLogger(__name__)
+
+
+def serialize_schema(
+    question: str,
+    db_id: str,
+    db_column_names: Dict[str, list],
+    db_table_names: List[str],
+    get_matches: Optional[Callable[[str, str], List[str]]] = None,
+    schema_serialization_type: str = "peteshaw",
+    schema_serialization_randomized: bool = False,
+    schema_serialization_with_db_id: bool = True,
+    normalize_query: bool = True,
+) -> str:
+    """
+    Same serialization as `seq2seq.utils.spider.serialize_schema`, except that database
+    content is looked up through `get_matches(table_name, column_name)` (no content is
+    included when it is None).
+    """
+    if schema_serialization_type == "verbose":
+        db_id_str = "Database: {db_id}. "
+        table_sep = ". "
+        table_str = "Table: {table}. Columns: {columns}"
+        column_sep = ", "
+        column_str_with_values = "{column} ({values})"
+        column_str_without_values = "{column}"
+        value_sep = ", "
+    elif schema_serialization_type == "peteshaw":
+        # see https://github.com/google-research/language/blob/master/language/nqg/tasks/spider/append_schema.py#L42
+        db_id_str = " | {db_id}"
+        table_sep = ""
+        table_str = " | {table} : {columns}"
+        column_sep = " , "
+        column_str_with_values = "{column} ( {values} )"
+        column_str_without_values = "{column}"
+        value_sep = " , "
+    else:
+        raise NotImplementedError
+
+    def get_column_str(table_name: str, column_name: str) -> str:
+        column_name_str = column_name.lower() if normalize_query else column_name
+        matches = get_matches(table_name, column_name) if get_matches else None
+        if matches:
+            return column_str_with_values.format(column=column_name_str, values=value_sep.join(matches))
+        return column_str_without_values.format(column=column_name_str)
+
+    tables = [
+        table_str.format(
+            table=table_name.lower() if normalize_query else table_name,
+            columns=column_sep.join(
+                get_column_str(table_name=table_name, column_name=column_name)
+                for column_table_id, column_name in zip(db_column_names["table_id"], db_column_names["column_name"])
+                if column_table_id == table_id
+            ),
+        )
+        for table_id, table_name in enumerate(db_table_names)
+    ]
+    if schema_serialization_randomized:
+        random.shuffle(tables)
+    if schema_serialization_with_db_id:
+        return db_id_str.format(db_id=db_id) + table_sep.join(tables)
+    return table_sep.join(tables)
+
+
+@dataclass
+class SchemaEntry:
+    db_id: str
+    path: str
+    fingerprint: Fingerprint
+    schema: dict
+    value_index: Optional[ValueIndex] = None
+    # question independent serializations, keyed by serialization options
+    serialized: Dict[tuple, str] = field(default_factory=dict)
+    # token ids of serialized schemas, keyed by (tokenizer, serialized schema)
+    token_ids: "OrderedDict[tuple, List[int]]" = field(default_factory=OrderedDict)
+
+
+class SchemaCache:
+    """
+    Caches the schema of every database, its serializations and their token ids.
+
+    Entries are keyed by db_id and remember the fingerprint of the `.sqlite` file they
+    were read from; an entry is rebuilt as soon as the file on disk changes.
+
+    With `value_index_builder`, database content is matched through a `ValueIndex`, which is
+    built in the background for databases that lack an up-to-date one. Until it is ready,
+    content is matched by scanning the columns.
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        max_token_entries: int = 256,
+        value_index_builder: Optional[ValueIndexBuilder] = None,
+    ):
+        self.db_path = db_path
+        self.max_token_entries = max_token_entries
+        self.value_index_builder = value_index_builder
+        self._entries: Dict[str, SchemaEntry] = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.token_hits = self.token_misses = 0
+
+    def get(self, db_id: str) -> SchemaEntry:
+        path = sqlite_path(self.db_path, db_id)
+        current = fingerprint(path)
+        with self._lock:
+            entry = self._entries.get(db_id)
+        if entry is not None and entry.fingerprint == current:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        if entry is not None:
+            # picklists of the db content are cached by path only
+            get_column_picklist.cache_clear()
+        entry = SchemaEntry(
+            db_id=db_id,
+            path=path,
+            fingerprint=current,
+            schema=get_schema(db_path=self.db_path, db_id=db_id),
+        )
+        if self.value_index_builder is not None:
+            entry.value_index = ValueIndex.open(
+                self.db_path, db_id, source_fingerprint=current)
+            if entry.value_index is None:
+                self.value_index_builder.schedule(db_id)
+        with self._lock:
+            self._entries[db_id] = entry
+        return entry
+
+    def warm(self, db_id: str) -> None:
+        try:
+            self.get(db_id)
+        except Exception as e:
+            logger.warning(f"Could not read the schema of {db_id}: {e}")
+
+    def invalidate(self, db_id: str) -> None:
+        with self._lock:
+            entry = self._entries.pop(db_id, None)
+        if entry is not None:
+            get_column_picklist.cache_clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "token_hits": self.token_hits,
+                "token_misses": self.token_misses,
+            }
+
+    def serialize(
+        self,
+        entry: SchemaEntry,
+        question: str,
+        with_db_content: bool,
+        **serialization_kwargs,
+    ) -> str:
+        def get_matches(table_name: str, column_name: str) -> List[str]:
+            return get_database_matches(
+                question=question,
+                table_name=table_name,
+                column_name=column_name,
+                db_path=entry.path,
+            )
+
+        def serialize(get_matches=None) -> str:
+            return serialize_schema(
+                question=question,
+                db_id=entry.db_id,
+                db_column_names=entry.schema["db_column_names"],
+                db_table_names=entry.schema["db_table_names"],
+                get_matches=get_matches,
+                **serialization_kwargs,
+            )
+
+        if with_db_content and entry.value_index is not None:
+            matches = entry.value_index.matches(question)
+            return serialize(lambda table_name, column_name: matches.get((table_name, column_name)))
+        if with_db_content:
+            return serialize(get_matches)
+        if serialization_kwargs.get("schema_serialization_randomized"):
+            return serialize()
+        key = tuple(sorted(serialization_kwargs.items()))
+        serialized = entry.serialized.get(key)
+        if serialized is None:
+            serialized = entry.serialized[key] = serialize()
+        return serialized
+
+    def tokenize(self, entry: SchemaEntry, tokenizer, serialized_schema: str) -> List[int]:
+        key = (tokenizer.name_or_path, serialized_schema)
+        with self._lock:
+            token_ids = entry.token_ids.get(key)
+            if token_ids is not None:
+                entry.token_ids.move_to_end(key)
+                self.token_hits += 1
+                return token_ids
+            self.token_misses += 1
+        token_ids = tokenizer(serialized_schema, add_special_tokens=False)[
+            "input_ids"]
+        with self._lock:
+            entry.token_ids[key] = token_ids
+            if len(entry.token_ids) > self.max_token_entries:
+                entry.token_ids.popitem(last=False)
+        return token_ids
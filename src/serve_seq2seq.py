@@ -1,19 +1,46 @@
+import time
+# start of the "imports" startup phase
+STARTED = time.perf_counter()
 from fastapi.openapi.utils import get_openapi
 import shutil
-from typing import Optional
+from typing import Awaitable, Callable, Iterator, List, Optional, TypeVar
 from seq2seq.utils.dataset import DataTrainingArguments
 from seq2seq.utils.picard_model_wrapper import PicardArguments, PicardLauncher, with_picard
-from seq2seq.utils.pipeline import Text2SQLGenerationPipeline, Text2SQLInput
-from sqlite3 import Connection, connect, OperationalError
-from uvicorn import run
+from seq2seq.utils.pipeline import Text2SQLInput
+from sqlite3 import Connection, OperationalError
 from fastapi import FastAPI, HTTPException, Body, File, UploadFile
-from transformers.models.auto import AutoConfig, AutoTokenizer, AutoModelForSeq2SeqLM
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from fastapi import Request
+from transformers.models.auto import AutoConfig, AutoTokenizer
+from transformers.tokenization_utils_base import PreTrainedTokenizerBase
 from transformers.hf_argparser import HfArgumentParser
-from contextlib import nullcontext
+from contextlib import contextmanager, nullcontext
+from model_registry import ModelKey, ModelRegistry
+from backends import check_backend, load_model
+from batching import MicroBatcher
+from schema_cache import SchemaCache
+from serving_pipeline import Text2SQLServingPipeline
+from db_files import fingerprint, sqlite_path, store_database
+from db_catalog import DatabaseCatalog
+from db_pool import ConnectionPool
+from execution import QueryTimeout, ResultCursors, execute_query, iter_query
+from query_guard import QueryGuard, QueryRejected
+from result_cache import ResultCache, ResultKey, normalize_question
+from executors import BoundedExecutor, Overloaded, iterate_in, physical_cores
+from metrics import MetricsRegistry, Phases, labels, record_timing, request_timings, server_timing
+from export_model import read_manifest
+from batch_questions import BatchQuestion, completed, parse_questions, read_jsonl
+from concurrent.futures import ThreadPoolExecutor
+from fastapi.concurrency import run_in_threadpool
+import asyncio
+import threading
+import torch
 import os
 from pydantic import BaseModel
 from dataclasses import dataclass, field
 import sys
+import json
 import logging
 
 logging.basicConfig(
@@ -24,6 +51,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 @dataclass
 class BackendArguments:
@@ -39,6 +68,12 @@ class BackendArguments:
         default="/tmp",
         metadata={"help": "Where to cache pretrained models and data"},
     )
+    artifact_path: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Load the served model, its tokenizer and config from a directory written by export_model.py instead of resolving model_path through the hub."
+        },
+    )
     db_path: str = field(
         default="/database",
         metadata={"help": "Where to to find the sqlite files"},
@@ -53,6 +88,164 @@ class BackendArguments:
             "help": "Device ordinal for CPU/GPU supports. Setting this to -1 will leverage CPU. A non-negative value will run the model on the corresponding CUDA device id."
         },
     )
+    inference_backend: str = field(
+        default="fp32",
+        metadata={
+            "help": "How to run the model: fp32, int8 (dynamically quantized Linear layers), bf16 or onnx (ONNX Runtime, requires optimum). See benchmark.py --backends to compare them."
+        },
+    )
+    model_memory_budget_mb: int = field(
+        default=16384,
+        metadata={
+            "help": "Memory budget (in MiB) for the weights of the models kept loaded for POST /ask. Least recently used models are evicted first."
+        },
+    )
+    value_index: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether to match questions against database content through a trigram index built next to each database, instead of scanning the columns."
+        },
+    )
+    value_index_max_values: int = field(
+        default=100000,
+        metadata={"help": "Maximum number of distinct values indexed per column."},
+    )
+    catalog_refresh_interval: float = field(
+        default=30.0,
+        metadata={
+            "help": "Interval (in seconds) at which the catalog of databases is checked against the disk. 0 disables the checks, databases added since startup are still found on first use."
+        },
+    )
+    prewarm_databases: int = field(
+        default=32,
+        metadata={
+            "help": "Number of the most used databases whose schema and connections are warmed up at startup, and again when they change on disk."
+        },
+    )
+    sqlite_pool_size: int = field(
+        default=4,
+        metadata={"help": "Number of idle read-only connections kept open per database."},
+    )
+    sqlite_mmap_size_mb: int = field(
+        default=256,
+        metadata={"help": "Size (in MiB) of the memory-mapped region of each pooled connection."},
+    )
+    sqlite_cache_size_mb: int = field(
+        default=64,
+        metadata={"help": "Size (in MiB) of the page cache of each pooled connection."},
+    )
+    sqlite_immutable: bool = field(
+        default=False,
+        metadata={
+            "help": "Open databases as immutable. Only safe if database files are never modified in place."
+        },
+    )
+    max_result_rows: int = field(
+        default=1000,
+        metadata={
+            "help": "Maximum number of rows returned per query. Further rows are available through the returned cursor."
+        },
+    )
+    query_timeout: float = field(
+        default=10.0,
+        metadata={"help": "Wall-clock limit (in seconds) for executing a generated query. 0 disables it."},
+    )
+    query_guard: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether to check generated queries against their query plan before running them, rewriting or rejecting the expensive ones."
+        },
+    )
+    max_query_cost: float = field(
+        default=1e7,
+        metadata={
+            "help": "Number of rows the query plan of a generated query may visit before it is rewritten with a LIMIT or rejected."
+        },
+    )
+    first_success: bool = field(
+        default=False,
+        metadata={
+            "help": "With several generated queries (num_return_sequences > 1), run them in parallel and only return the best ranked one that passes the guard and succeeds."
+        },
+    )
+    workers: int = field(
+        default=1,
+        metadata={
+            "help": "Number of server processes. Workers are forked after the model is loaded and PICARD is started, and share both. The progress of POST /proxy/ jobs is shared through files next to the databases, so any worker can report it."
+        },
+    )
+    inference_workers: int = field(
+        default=1,
+        metadata={"help": "Number of batches generated concurrently."},
+    )
+    torch_threads: int = field(
+        default=0,
+        metadata={
+            "help": "Intra-op threads used by each inference worker. 0 splits the physical cores evenly between the inference workers of all server processes."
+        },
+    )
+    sql_workers: int = field(
+        default=4,
+        metadata={"help": "Number of threads executing generated queries."},
+    )
+    max_queue_size: int = field(
+        default=64,
+        metadata={
+            "help": "Maximum number of questions (and of queries) pending at a time. Further requests are rejected with 503. 0 disables the limit."
+        },
+    )
+    batch_window: int = field(
+        default=0,
+        metadata={
+            "help": "Number of questions of a POST /ask/batch generated or executed at a time. 0 uses twice the number of questions all inference workers batch together."
+        },
+    )
+    max_batch_questions: int = field(
+        default=10000,
+        metadata={"help": "Maximum number of questions of a POST /ask/batch."},
+    )
+    result_cache_size: int = field(
+        default=1024,
+        metadata={"help": "Number of (database, question, model) results kept in the result cache. 0 disables it."},
+    )
+    result_cache_ttl: float = field(
+        default=3600.0,
+        metadata={"help": "Time to live (in seconds) of result cache entries."},
+    )
+    cache_execution_results: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to also cache the execution results of the generated queries, not only the queries."
+        },
+    )
+    proxy_parallelism: int = field(
+        default=4,
+        metadata={"help": "Number of MySQL tables read concurrently when converting a proxied database."},
+    )
+    max_batch_size: int = field(
+        default=8,
+        metadata={
+            "help": "Maximum number of concurrent GET /ask questions coalesced into a single generate() call."
+        },
+    )
+    max_batch_wait_ms: float = field(
+        default=10.0,
+        metadata={
+            "help": "How long (in milliseconds) to wait for more questions before running a partial batch."
+        },
+    )
+    server_timing: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to add a Server-Timing header with the duration of every stage to responses."
+        },
+    )
+    warmup: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether to warm up the most used databases (see prewarm_databases) and run one generation before reporting ready on GET /readyz."
+        },
+    )
 
 
 def delete_folders(path, dir_to_keep):
@@ -66,174 +259,756 @@ def delete_folders(path, dir_to_keep):
         shutil.rmtree(subdir_path)
 
 
-def main():
-    # See all possible arguments by passing the --help flag to this program.
-    parser = HfArgumentParser(
-        (PicardArguments, BackendArguments, DataTrainingArguments))
-    picard_args: PicardArguments
-    backend_args: BackendArguments
-    data_training_args: DataTrainingArguments
-    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
-        # If we pass only one argument to the script and it's the path to a json file,
-        # let's parse it to get our arguments.
-        picard_args, backend_args, data_training_args = parser.parse_json_file(
-            json_file=os.path.abspath(sys.argv[1]))
-    else:
-        picard_args, backend_args, data_training_args = parser.parse_args_into_dataclasses()
+def create_app(
+    backend_args: BackendArguments,
+    data_training_args: DataTrainingArguments,
+    tokenizer: PreTrainedTokenizerBase,
+    model_cls_wrapper: Callable[[type], type] = lambda model_cls: model_cls,
+    phases: Optional[Phases] = None,
+) -> FastAPI:
+    """
+    Loads the served model and builds the REST API around it, without serving it, so that
+    the app can also be driven in-process (e.g. by benchmark.py). The number of threads
+    torch should use per worker is left in `app.state.torch_threads`.
 
-    # Initialize config
-    config = AutoConfig.from_pretrained(
-        backend_args.model_path,
-        cache_dir=backend_args.cache_dir,
-        max_length=data_training_args.max_target_length,
-        num_beams=data_training_args.num_beams,
-        num_beam_groups=data_training_args.num_beam_groups,
-        diversity_penalty=data_training_args.diversity_penalty,
-    )
+    Startup phases are recorded in `phases`. The app reports ready on GET /readyz once it
+    is warm, see `BackendArguments.warmup`.
+    """
+    if phases is None:
+        phases = Phases()
 
-    # Initialize tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(
-        backend_args.model_path,
-        cache_dir=backend_args.cache_dir,
-        use_fast=True,
+    # Serialized schemas and their token ids, shared by all models
+    value_index_builder = None
+    if backend_args.value_index:
+        from value_index import ValueIndexBuilder
+        value_index_builder = ValueIndexBuilder(
+            backend_args.db_path,
+            on_built=lambda db_id: schemas.invalidate(db_id),
+            max_values_per_column=backend_args.value_index_max_values,
+        )
+    schemas = SchemaCache(
+        backend_args.db_path, value_index_builder=value_index_builder)
+
+    def prewarm(db_id: str) -> None:
+        schemas.warm(db_id)
+        try:
+            with pool.connection(sqlite_path(backend_args.db_path, db_id)):
+                pass
+        except OperationalError as e:
+            logger.warning(f"Could not open {db_id}: {e}")
+
+    def rewarm(db_id: str) -> None:
+        if db_id in catalog.most_used(backend_args.prewarm_databases):
+            prewarm(db_id)
+
+    # Databases known to the server, read before forking workers so that they share it
+    with phases.phase("catalog"):
+        catalog = DatabaseCatalog(
+            backend_args.db_path, refresh_interval=backend_args.catalog_refresh_interval, on_change=rewarm)
+        catalog.refresh()
+
+    generation_config = (
+        data_training_args.max_target_length,
+        data_training_args.num_beams,
+        data_training_args.num_beam_groups,
+        data_training_args.diversity_penalty,
+        backend_args.inference_backend,
     )
 
-    # Initialize Picard if necessary
-    with PicardLauncher() if picard_args.launch_picard else nullcontext(None):
-        # Get Picard model class wrapper
-        if picard_args.use_picard:
-            def model_cls_wrapper(model_cls): return with_picard(
-                model_cls=model_cls, picard_args=picard_args, tokenizer=tokenizer
-            )
-        else:
-            def model_cls_wrapper(model_cls): return model_cls
+    def load_pipeline(
+        model_path: str,
+        cache_dir: Optional[str],
+        db_path: str,
+        device: int,
+        local_files_only: bool = False,
+    ) -> Text2SQLServingPipeline:
+        # Initialize config
+        config = AutoConfig.from_pretrained(
+            model_path,
+            cache_dir=cache_dir,
+            local_files_only=local_files_only,
+            max_length=data_training_args.max_target_length,
+            num_beams=data_training_args.num_beams,
+            num_beam_groups=data_training_args.num_beam_groups,
+            diversity_penalty=data_training_args.diversity_penalty,
+        )
 
         # Initialize model
-        model = model_cls_wrapper(AutoModelForSeq2SeqLM).from_pretrained(
-            backend_args.model_path,
+        model = load_model(
+            model_cls_wrapper,
+            model_path,
             config=config,
-            cache_dir=backend_args.cache_dir,
+            backend=backend_args.inference_backend,
+            cache_dir=cache_dir,
+            local_files_only=local_files_only,
         )
+        return make_pipeline(model=model, db_path=db_path, device=device)
 
+    def make_pipeline(model, db_path: str, device: int) -> Text2SQLServingPipeline:
         # Initalize generation pipeline
-        pipe = Text2SQLGenerationPipeline(
+        return Text2SQLServingPipeline(
             model=model,
             tokenizer=tokenizer,
-            db_path=backend_args.db_path,
+            db_path=db_path,
+            schemas=schemas if db_path == backend_args.db_path else SchemaCache(db_path),
             prefix=data_training_args.source_prefix,
             normalize_query=data_training_args.normalize_query,
             schema_serialization_type=data_training_args.schema_serialization_type,
             schema_serialization_with_db_id=data_training_args.schema_serialization_with_db_id,
             schema_serialization_with_db_content=data_training_args.schema_serialization_with_db_content,
+            device=device,
+        )
+
+    with phases.phase("model"):
+        pipe = load_pipeline(
+            model_path=backend_args.artifact_path or backend_args.model_path,
+            cache_dir=backend_args.cache_dir,
+            db_path=backend_args.db_path,
             device=backend_args.device,
+            local_files_only=backend_args.artifact_path is not None,
         )
 
-        # Initialize REST API
-        app = FastAPI()
-
-        def custom_openapi():
-            if app.openapi_schema:
-                return app.openapi_schema
-            openapi_schema = get_openapi(
-                title="EZ-PICARD",
-                version="0.0.1",
-                description="EZ-PICARD is a eazy implementation of the PICARD framework for text-to-SQL generation.",
-                routes=app.routes,
-            )
-            app.openapi_schema = openapi_schema
+    # Keep the served model and every model requested through POST /ask resident
+    registry = ModelRegistry(
+        memory_budget=backend_args.model_memory_budget_mb << 20)
+    registry.add(
+        ModelKey(backend_args.model_path,
+                 backend_args.device, generation_config),
+        pipe,
+        pinned=True,
+    )
+
+    # Read-only connections to the databases, reused across requests
+    pool = ConnectionPool(
+        max_idle=backend_args.sqlite_pool_size,
+        mmap_size=backend_args.sqlite_mmap_size_mb << 20,
+        cache_size_kib=backend_args.sqlite_cache_size_mb << 10,
+        immutable=backend_args.sqlite_immutable,
+    )
+
+    # Generation and query execution run on their own bounded thread pools
+    torch_threads = backend_args.torch_threads or max(
+        1, physical_cores() // (backend_args.inference_workers * backend_args.workers))
+    torch.set_num_threads(torch_threads)
+    inference_executor = ThreadPoolExecutor(
+        max_workers=backend_args.inference_workers, thread_name_prefix="inference")
+    inference = BoundedExecutor(
+        inference_executor, max_pending=backend_args.max_queue_size)
+    sql = BoundedExecutor(
+        ThreadPoolExecutor(max_workers=backend_args.sql_workers,
+                           thread_name_prefix="sql"),
+        max_pending=backend_args.max_queue_size,
+    )
+
+    # Generated queries (and optionally their results) of recently asked questions
+    results_cache = ResultCache(
+        max_entries=backend_args.result_cache_size, ttl=backend_args.result_cache_ttl)
+
+    # Per-stage latencies, queue depths, throughput and cache hit rates, see GET /metrics
+    metrics = MetricsRegistry(namespace="ezpicard")
+    stage_seconds = metrics.histogram(
+        "stage_seconds", "Time spent per stage: schema, tokenize, generate, picard, decode (per batch), queue, pipeline, sql (per request).")
+    request_seconds = metrics.histogram(
+        "request_seconds", "Time to serve a request, per endpoint and status.")
+    batch_size = metrics.histogram(
+        "batch_size", "Number of questions per beam search.", buckets=(1, 2, 4, 8, 16, 32, 64))
+    generated_tokens = metrics.counter(
+        "generated_tokens_total", "Tokens generated by beam search, over all beams.")
+    generation_throughput = metrics.histogram(
+        "generation_tokens_per_second", "Tokens generated per second of beam search, per batch.",
+        buckets=(10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000))
+    rejected_tokens = metrics.counter(
+        "picard_rejected_tokens_total", "Candidate tokens rejected by PICARD.")
+    metrics.gauge("queue_depth", "Requests queued or running, per queue.", lambda: {
+        labels(queue="batcher"): batcher.pending,
+        labels(queue="inference"): inference.pending,
+        labels(queue="sql"): sql.pending,
+    })
+
+    def cache_requests():
+        results, schema = results_cache.stats(), schemas.stats()
+        return {
+            labels(cache="results", result="hit"): results["hits"],
+            labels(cache="results", result="miss"): results["misses"],
+            labels(cache="schemas", result="hit"): schema["hits"],
+            labels(cache="schemas", result="miss"): schema["misses"],
+            labels(cache="schema_tokens", result="hit"): schema["token_hits"],
+            labels(cache="schema_tokens", result="miss"): schema["token_misses"],
+        }
+
+    metrics.gauge("databases", "Databases in the catalog.",
+                  lambda: len(catalog.entries()))
+    metrics.collected_counter(
+        "cache_requests_total", "Cache lookups, per cache and result.", cache_requests)
+
+    def on_batch(size: int, timings: dict) -> None:
+        batch_size.observe(size)
+        for name in ("schema", "tokenize", "generate", "picard", "decode"):
+            if name in timings:
+                stage_seconds.observe(timings[name], stage=name)
+        generated_tokens.inc(timings.get("tokens", 0))
+        rejected_tokens.inc(timings.get("rejected", 0))
+        if timings.get("generate"):
+            generation_throughput.observe(
+                timings.get("tokens", 0) / timings["generate"])
+
+    @contextmanager
+    def stage(name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stage_seconds.observe(seconds, stage=name)
+            record_timing(name, seconds)
+
+    # Coalesce concurrent GET /ask questions into batched beam searches
+    batcher = MicroBatcher(
+        pipe,
+        num_return_sequences=data_training_args.num_return_sequences,
+        max_batch_size=backend_args.max_batch_size,
+        max_wait_ms=backend_args.max_batch_wait_ms,
+        executor=inference_executor,
+        max_concurrent_batches=backend_args.inference_workers,
+        max_pending=backend_args.max_queue_size,
+        on_batch=on_batch,
+    )
+
+    # Initialize REST API
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def instrument(request: Request, call_next):
+        start = time.perf_counter()
+        with request_timings() as timings:
+            response = await call_next(request)
+        seconds = time.perf_counter() - start
+        endpoint = getattr(request.scope.get(
+            "endpoint"), "__name__", "unmatched")
+        request_seconds.observe(
+            seconds, endpoint=endpoint, status=response.status_code)
+        if backend_args.server_timing:
+            timings["total"] = seconds
+            response.headers["Server-Timing"] = server_timing(timings)
+        return response
+
+    def custom_openapi():
+        if app.openapi_schema:
             return app.openapi_schema
+        openapi_schema = get_openapi(
+            title="EZ-PICARD",
+            version="0.0.1",
+            description="EZ-PICARD is a eazy implementation of the PICARD framework for text-to-SQL generation.",
+            routes=app.routes,
+        )
+        app.openapi_schema = openapi_schema
+        return app.openapi_schema
 
-        app.openapi = custom_openapi
+    app.openapi = custom_openapi
 
-        class AskResponse(BaseModel):
-            query: str
-            execution_results: list
+    class AskResponse(BaseModel):
+        query: str
+        execution_results: list
+        truncated: bool = False
+        next_cursor: Optional[str] = None
 
-        def response(query: str, conn: Connection) -> AskResponse:
-            try:
-                return AskResponse(query=query, execution_results=conn.execute(query).fetchall())
-            except OperationalError as e:
-                raise HTTPException(
-                    status_code=500, detail=f'while executing "{query}", the following error occurred: {e.args[0]}'
-                )
+    cursors = ResultCursors()
+
+    guard = QueryGuard(
+        max_cost=backend_args.max_query_cost) if backend_args.query_guard else None
+
+    def guarded(conn: Connection, query: str, max_rows: int) -> str:
+        return guard.check(conn, query, max_rows) if guard is not None else query
+
+    def response(
+        query: str, conn: Connection, path: str, limit: int, offset: int = 0, cancelled: Optional[threading.Event] = None
+    ) -> AskResponse:
+        try:
+            result = execute_query(
+                conn, guarded(conn, query, offset + limit + 1), max_rows=limit, offset=offset,
+                timeout=backend_args.query_timeout, cancelled=cancelled)
+        except QueryRejected as e:
+            raise HTTPException(
+                status_code=422, detail=f'while checking "{query}", the following error occurred: {e.args[0]}'
+            )
+        except QueryTimeout as e:
+            raise HTTPException(
+                status_code=504, detail=f'while executing "{query}", the following error occurred: {e.args[0]}'
+            )
+        except OperationalError as e:
+            raise HTTPException(
+                status_code=500, detail=f'while executing "{query}", the following error occurred: {e.args[0]}'
+            )
+        return AskResponse(
+            query=query,
+            execution_results=result.rows,
+            truncated=result.truncated,
+            next_cursor=cursors.encode(
+                path, query, offset + limit, limit) if result.truncated else None,
+        )
+
+    def row_limit(limit: Optional[int]) -> int:
+        return max(1, min(limit or backend_args.max_result_rows, backend_args.max_result_rows))
+
+    def stream_response(path: str, queries: List[str], limit: int) -> StreamingResponse:
+        def lines() -> Iterator[str]:
+            for query in queries:
+                yield json.dumps({"query": query}) + "\n"
+                try:
+                    with pool.connection(path) as conn:
+                        for row in iter_query(conn, guarded(conn, query, limit), max_rows=limit, timeout=backend_args.query_timeout):
+                            yield json.dumps({"row": jsonable_encoder(row)}) + "\n"
+                except OperationalError as e:
+                    yield json.dumps({"error": f'while executing "{query}", the following error occurred: {e.args[0]}'}) + "\n"
 
-        @app.get("/ask/{db_id}/{question}")
-        def ask(db_id: str = 'chinook', question: str = 'how many singers we have?'):
+        return StreamingResponse(iterate_in(sql, lines()), media_type="application/x-ndjson")
+
+    async def run_sql(fn: Callable[..., T], *args) -> T:
+        try:
+            return await sql.run(fn, *args)
+        except Overloaded as e:
+            raise HTTPException(status_code=503, detail=e.args[0])
+
+    def responses(path: str, queries: List[str], limit: int) -> List[AskResponse]:
+        """
+        The responses of the `queries` the guard accepts, raising 422 if it rejects them all.
+        """
+        results, rejected = [], []
+        with pool.connection(path) as conn:
+            for query in queries:
+                try:
+                    results.append(response(
+                        query=query, conn=conn, path=path, limit=limit))
+                except HTTPException as e:
+                    if e.status_code != 422:
+                        raise
+                    # fall through to the next candidate
+                    rejected.append(e.detail)
+        if not results:
+            raise HTTPException(
+                status_code=422, detail=rejected[0] if len(rejected) == 1 else rejected)
+        return results
+
+    async def first_success(path: str, queries: List[str], limit: int) -> List[AskResponse]:
+        """
+        Runs all `queries` in parallel, and returns the response of the best ranked one that
+        succeeds, interrupting the others.
+        """
+        cancelled = threading.Event()
+
+        def run(query: str) -> AskResponse:
+            with pool.connection(path) as conn:
+                return response(query=query, conn=conn, path=path, limit=limit, cancelled=cancelled)
+
+        tasks = [asyncio.ensure_future(run_sql(run, query))
+                 for query in queries]
+        errors = []
+        try:
+            for task in tasks:
+                try:
+                    return [await task]
+                except HTTPException as e:
+                    if e.status_code == 503:
+                        raise
+                    errors.append(e.detail)
+        finally:
+            cancelled.set()
+            for task in tasks:
+                task.cancel()
+                # failures of the queries that lost the race are expected
+                task.add_done_callback(
+                    lambda task: task.cancelled() or task.exception())
+        raise HTTPException(status_code=422, detail=errors)
+
+    async def answer(
+        path: str,
+        question: str,
+        model_path: str,
+        num_return_sequences: int,
+        generate: Callable[[], Awaitable[List[dict]]],
+        limit: int,
+        stream: bool,
+    ):
+        try:
+            db_fingerprint = fingerprint(path)
+        except OperationalError as e:
+            raise HTTPException(status_code=404, detail=e.args[0])
+        key = ResultKey(path, normalize_question(question), model_path,
+                        generation_config + (num_return_sequences,))
+        cached = results_cache.get(key, db_fingerprint)
+        if cached is None:
             try:
-                outputs = pipe(
-                    inputs=Text2SQLInput(utterance=question, db_id=db_id),
-                    num_return_sequences=data_training_args.num_return_sequences,
-                )
+                outputs = await generate()
+            except Overloaded as e:
+                raise HTTPException(status_code=503, detail=e.args[0])
             except OperationalError as e:
                 raise HTTPException(status_code=404, detail=e.args[0])
+            cached = {"queries": [output["generated_text"]
+                                  for output in outputs], "responses": None}
+            results_cache.put(key, db_fingerprint, cached)
+        if stream:
+            return stream_response(path, cached["queries"], limit)
+        cacheable = backend_args.cache_execution_results and limit == row_limit(None)
+        if cacheable and cached["responses"] is not None:
+            return cached["responses"]
+        with stage("sql"):
+            if backend_args.first_success and len(cached["queries"]) > 1:
+                results = await first_success(path, cached["queries"], limit)
+            else:
+                results = await run_sql(responses, path, cached["queries"], limit)
+        if cacheable:
+            cached["responses"] = results
+        return results
+
+    async def generated(future) -> List[dict]:
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            stage_seconds.observe(future.timings.get("queue", 0.0), stage="queue")
+            for name, seconds in future.timings.items():
+                if name not in ("tokens", "rejected"):
+                    record_timing(name, seconds)
+
+    def database(db_id: str) -> str:
+        """
+        The path of the database `db_id`, raising 404 if it is not in the catalog.
+        """
+        entry = catalog.get(db_id)
+        if entry is None:
+            raise HTTPException(
+                status_code=404, detail=f"unknown database {db_id}")
+        catalog.record_use(db_id)
+        return entry.path
+
+    @app.get("/ask/{db_id}/{question}")
+    async def ask(db_id: str = 'chinook', question: str = 'how many singers we have?', limit: Optional[int] = None, stream: bool = False):
+        return await answer(
+            path=database(db_id),
+            question=question,
+            model_path=backend_args.model_path,
+            num_return_sequences=data_training_args.num_return_sequences,
+            generate=lambda: generated(batcher.submit(
+                Text2SQLInput(utterance=question, db_id=db_id))),
+            limit=row_limit(limit),
+            stream=stream,
+        )
+
+    async def batch_questions(request: Request) -> List[BatchQuestion]:
+        content_type = request.headers.get("content-type", "")
+        try:
+            if content_type.startswith("multipart/form-data"):
+                form = await request.form()
+                if "file" not in form:
+                    raise ValueError("expected a JSONL file in the file field")
+                questions = read_jsonl(await form["file"].read())
+            elif content_type.startswith(("application/x-ndjson", "application/jsonl")):
+                questions = read_jsonl(await request.body())
+            else:
+                questions = parse_questions(await request.json())
+        except ValueError as e:
+            # including malformed JSON bodies
+            raise HTTPException(status_code=400, detail=str(e))
+        if len(questions) > backend_args.max_batch_questions:
+            raise HTTPException(
+                status_code=413, detail=f"{len(questions)} questions, at most {backend_args.max_batch_questions} are accepted")
+        return questions
+
+    @app.post("/ask/batch")
+    async def ask_batch(request: Request, limit: Optional[int] = None):
+        """
+        Answers a list of `[db_id, question]` pairs or `{"db_id", "question", "id"}` objects,
+        sent as JSON, as JSONL or as a JSONL file upload (field `file`). Answers are streamed
+        back as NDJSON in the order they complete, with the `index` of their question.
+        """
+        questions = await batch_questions(request)
+        limit = row_limit(limit)
+        window = backend_args.batch_window or 2 * \
+            backend_args.max_batch_size * backend_args.inference_workers
+
+        async def answer_one(indexed) -> dict:
+            index, question = indexed
+            line = {"index": index, "db_id": question.db_id,
+                    "question": question.question}
+            if question.id is not None:
+                line["id"] = question.id
             try:
-                conn = connect(
-                    f"{backend_args.db_path}/{db_id}/{db_id}.sqlite")
-                return [response(query=output["generated_text"], conn=conn) for output in outputs]
-            finally:
-                conn.close()
-
-        @app.get("/dbs")
-        def dbs():
-            return [db for db in os.listdir(backend_args.db_path) if os.path.isdir(os.path.join(backend_args.db_path, db))]
-
-        @app.post("/upload/")
-        async def upload(file: UploadFile = File(...)):
-            try:
-                # delete_folders(backend_args.db_path, "chinook")
-                path = f'{backend_args.db_path}/{file.filename.split(".")[0]}'
-                os.makedirs(path, exist_ok=True)
-                with open(f'{path}/{file.filename}', 'wb') as f:
-                    shutil.copyfileobj(file.file, f)
-            except Exception as e:
-                raise HTTPException(status_code=400, detail=e)
-            finally:
-                file.file.close()
-            return {"message": f"Successfully uploaded {file.filename}"}
-
-        # # post request that gets configs, db_id and question and model_path
-        @app.post("/ask/{db_id}/{question}")
-        def ask(db_id: str = 'chinook', question: str = 'how many singers we have?', backend_args: dict = Body(...)):
-            try:
-                config = AutoConfig.from_pretrained(
-                    backend_args['model_path'],
-                    cache_dir=backend_args['cache_dir'],
-                    max_length=data_training_args.max_target_length,
-                    num_beams=data_training_args.num_beams,
-                    num_beam_groups=data_training_args.num_beam_groups,
-                    diversity_penalty=data_training_args.diversity_penalty,
-                )
-                model = model_cls_wrapper(AutoModelForSeq2SeqLM).from_pretrained(
-                    backend_args["model_path"],
-                    config=config,
-                    cache_dir=backend_args['cache_dir'],
-                )
-                pipe = Text2SQLGenerationPipeline(
-                    model=model,
-                    tokenizer=tokenizer,
-                    db_path=backend_args['db_path'],
-                    prefix=data_training_args.source_prefix,
-                    normalize_query=data_training_args.normalize_query,
-                    schema_serialization_type=data_training_args.schema_serialization_type,
-                    schema_serialization_with_db_id=data_training_args.schema_serialization_with_db_id,
-                    schema_serialization_with_db_content=data_training_args.schema_serialization_with_db_content,
-                    device=backend_args['device'],
-                )
-                outputs = pipe(
-                    inputs=Text2SQLInput(utterance=question, db_id=db_id),
-                    num_return_sequences=1,
-                )
-            except OperationalError as e:
-                raise HTTPException(status_code=404, detail=e)
+                line["results"] = jsonable_encoder(await answer(
+                    path=database(question.db_id),
+                    question=question.question,
+                    model_path=backend_args.model_path,
+                    num_return_sequences=data_training_args.num_return_sequences,
+                    generate=lambda: generated(batcher.submit(
+                        Text2SQLInput(utterance=question.question, db_id=question.db_id))),
+                    limit=limit,
+                    stream=False,
+                ))
+            except HTTPException as e:
+                line["status"], line["error"] = e.status_code, e.detail
+            return line
+
+        async def lines():
+            # questions on the same database are submitted together, so that they share
+            # batches and their schema stays cached
+            ordered = sorted(enumerate(questions),
+                             key=lambda indexed: indexed[1].db_id)
+            async for line in completed(ordered, answer_one, window):
+                yield json.dumps(line) + "\n"
+
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+    @app.get("/cache")
+    def cache():
+        return results_cache.stats()
+
+    # Liveness and readiness: the app is ready once the schemas are read and a generation ran
+    ready = threading.Event()
+    metrics.gauge("startup_phase_seconds", "Duration of every startup phase.",
+                  lambda: {labels(phase=name): seconds for name, seconds in phases.seconds.items()})
+
+    def warm_up() -> None:
+        try:
+            with phases.phase("warmup"):
+                db_ids = catalog.most_used(backend_args.prewarm_databases)
+                for db_id in db_ids:
+                    prewarm(db_id)
+                if db_ids:
+                    pipe(inputs=Text2SQLInput(utterance="warm up",
+                         db_id=db_ids[0]), num_return_sequences=1)
+        except Exception:
+            logger.exception("Warming up failed")
+        finally:
+            ready.set()
+
+    @app.on_event("startup")
+    def start_warm_up() -> None:
+        # in every worker, after the fork
+        catalog.start()
+        if backend_args.warmup:
+            inference_executor.submit(warm_up)
+        else:
+            ready.set()
+
+    @app.on_event("shutdown")
+    def stop_catalog() -> None:
+        catalog.stop()
+
+    @app.get("/healthz")
+    def healthz():
+        return {"status": "ok"}
+
+    @app.get("/readyz")
+    def readyz():
+        if not ready.is_set():
+            raise HTTPException(status_code=503, detail="warming up")
+        return {"status": "ready", "startup": phases.seconds}
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/results/{cursor}")
+    async def results(cursor: str):
+        try:
+            page = cursors.decode(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=e.args[0])
+
+        def run() -> AskResponse:
+            with pool.connection(page["path"]) as conn:
+                return response(query=page["query"], conn=conn, path=page["path"], limit=page["limit"], offset=page["offset"])
+
+        try:
+            with stage("sql"):
+                return await run_sql(run)
+        except OperationalError as e:
+            raise HTTPException(status_code=404, detail=e.args[0])
+
+    @app.get("/dbs")
+    def dbs():
+        return [entry.db_id for entry in catalog.entries()]
+
+    @app.get("/dbs/{db_id}")
+    def db(db_id: str):
+        entry = catalog.get(db_id)
+        if entry is None:
+            raise HTTPException(
+                status_code=404, detail=f"unknown database {db_id}")
+        return entry.to_dict()
+
+    @app.get("/dbs/{db_id}/index")
+    def value_index(db_id: str):
+        try:
+            entry = schemas.get(db_id)
+        except OperationalError as e:
+            raise HTTPException(status_code=404, detail=e.args[0])
+        if entry.value_index is None:
+            raise HTTPException(
+                status_code=404, detail=f"the content of {db_id} is not indexed yet")
+        return entry.value_index.stats()
+
+    def replaced(db_id: str) -> None:
+        # the file of db_id changed: forget what was derived from the previous one
+        path = sqlite_path(backend_args.db_path, db_id)
+        pool.invalidate(path)
+        results_cache.invalidate(path)
+        catalog.update(db_id)
+        schemas.warm(db_id)
+
+    @app.post("/upload/")
+    async def upload(file: UploadFile = File(...)):
+        db_id = os.path.basename(file.filename).split(".")[0]
+        if not db_id:
+            raise HTTPException(
+                status_code=400, detail=f"invalid file name {file.filename}")
+        path = sqlite_path(backend_args.db_path, db_id)
+        try:
+            # the request body is already spooled to disk, copy it off the event loop
+            stored = await run_in_threadpool(store_database, file.file, path)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=e.args[0])
+        finally:
+            await file.close()
+        if stored.changed:
+            await run_in_threadpool(replaced, db_id)
+        return {"message": f"Successfully uploaded {file.filename}", "db_id": db_id,
+                "sha256": stored.sha256, "size": stored.size, "changed": stored.changed}
+
+    try:
+        from db_adapter.mysql_proxy import ConversionJobs
+    except ImportError:
+        # mysql-connector-python is only needed to proxy MySQL databases
+        ConversionJobs = None
+    if ConversionJobs is not None:
+        # on the conversion thread, once the copy is synced
+        conversions = ConversionJobs(
+            backend_args.db_path, parallelism=backend_args.proxy_parallelism,
+            on_done=lambda job: replaced(job.sqlite_name))
+
+        @app.post("/proxy/")
+        def proxy(connection_string: str = Body(...)):
             try:
-                conn = connect(
-                    f"{backend_args.db_path}/{db_id}/{db_id}.sqlite")
-                return [response(query=output["generated_text"], conn=conn) for output in outputs]
-            finally:
-                conn.close()
+                return conversions.submit(connection_string).to_dict()
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=e.args[0])
+
+        @app.get("/proxy/{job_id}")
+        def proxy_job(job_id: str):
+            job = conversions.get(job_id)
+            if job is None:
+                raise HTTPException(
+                    status_code=404, detail=f"no conversion job {job_id}")
+            return job.to_dict()
+
+    # # post request that gets configs, db_id and question and model_path
+    @app.post("/ask/{db_id}/{question}")
+    async def ask(db_id: str = 'chinook', question: str = 'how many singers we have?', model_args: dict = Body(...)):
+        db_path = model_args.get('db_path', backend_args.db_path)
+
+        def generate() -> List[dict]:
+            model_pipe = registry.get(
+                ModelKey(model_args['model_path'],
+                         model_args['device'], generation_config),
+                load=lambda: load_pipeline(
+                    model_path=model_args['model_path'],
+                    cache_dir=model_args.get('cache_dir'),
+                    db_path=db_path,
+                    device=model_args['device'],
+                ),
+            )
+            if model_pipe.db_path != db_path:
+                # reuse the resident weights, only the schema lookup differs
+                model_pipe = make_pipeline(
+                    model=model_pipe.model, db_path=db_path, device=model_args['device'])
+            return model_pipe(
+                inputs=Text2SQLInput(utterance=question, db_id=db_id),
+                num_return_sequences=1,
+            )
+
+        async def timed_generate() -> List[dict]:
+            # unbatched, so only the whole pipeline call is timed
+            with stage("pipeline"):
+                return await inference.run(generate)
+
+        # the catalog only covers the served databases
+        path = database(db_id) if db_path == backend_args.db_path else sqlite_path(
+            db_path, db_id)
+        return await answer(
+            path=path,
+            question=question,
+            model_path=model_args['model_path'],
+            num_return_sequences=1,
+            generate=timed_generate,
+            limit=row_limit(None),
+            stream=False,
+        )
+
+    app.state.torch_threads = torch_threads
+    return app
+
+
+def main():
+    # See all possible arguments by passing the --help flag to this program.
+    parser = HfArgumentParser(
+        (PicardArguments, BackendArguments, DataTrainingArguments))
+    picard_args: PicardArguments
+    backend_args: BackendArguments
+    data_training_args: DataTrainingArguments
+    if len(sys.argv) == 2 and sys.argv[1].endswith(".json"):
+        # If we pass only one argument to the script and it's the path to a json file,
+        # let's parse it to get our arguments.
+        picard_args, backend_args, data_training_args = parser.parse_json_file(
+            json_file=os.path.abspath(sys.argv[1]))
+    else:
+        picard_args, backend_args, data_training_args = parser.parse_args_into_dataclasses()
+
+    phases = Phases()
+    phases.record("imports", time.perf_counter() - STARTED)
+    # before anything is loaded
+    check_backend(backend_args.inference_backend)
+
+    if backend_args.artifact_path is not None:
+        # served under the name of the exported model, so that POST /ask can refer to it
+        backend_args.model_path = read_manifest(
+            backend_args.artifact_path)["model_path"]
+
+    # Initialize tokenizer
+    with phases.phase("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(
+            backend_args.artifact_path or backend_args.model_path,
+            cache_dir=backend_args.cache_dir,
+            use_fast=True,
+            local_files_only=backend_args.artifact_path is not None,
+        )
+
+    # Initialize Picard if necessary
+    with phases.phase("picard"):
+        launcher = PicardLauncher() if picard_args.launch_picard else nullcontext(None)
+    with launcher:
+        # Get Picard model class wrapper
+        if picard_args.use_picard:
+            def model_cls_wrapper(model_cls): return with_picard(
+                model_cls=model_cls, picard_args=picard_args, tokenizer=tokenizer
+            )
+        else:
+            def model_cls_wrapper(model_cls): return model_cls
+
+        app = create_app(backend_args, data_training_args,
+                         tokenizer, model_cls_wrapper, phases)
+        phases.record("startup", time.perf_counter() - STARTED)
 
         # Run app
-        run(app=app, host=backend_args.host, port=backend_args.port)
+        if backend_args.workers > 1:
+            from workers import serve_forked
+            serve_forked(
+                app=app,
+                host=backend_args.host,
+                port=backend_args.port,
+                workers=backend_args.workers,
+                on_fork=lambda: torch.set_num_threads(app.state.torch_threads),
+            )
+        else:
+            from uvicorn import run
+            run(app=app, host=backend_args.host, port=backend_args.port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from seq2seq.utils.picard_model_wrapper import PicardLogitsProcessor
+from seq2seq.utils.pipeline import Text2SQLGenerationPipeline, Text2SQLInput
+from seq2seq.utils.spider import spider_get_input
+from transformers.generation_logits_process import LogitsProcessorList
+from transformers.tokenization_utils_base import BatchEncoding
+
+from schema_cache import SchemaCache, SchemaEntry
+
+
+class PicardUsage(threading.local):
+    """
+    Time spent in PICARD and number of candidate tokens it rejected, per thread since the
+    last `reset`.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self.rejected = 0
+
+
+class CountingPicardLogitsProcessor:
+    """
+    Wraps a `PicardLogitsProcessor` to measure it and count the candidates it rejects
+    among the `max_tokens_to_check` best tokens of every beam.
+    """
+
+    def __init__(self, processor: PicardLogitsProcessor, usage: PicardUsage):
+        self.processor = processor
+        self.usage = usage
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
+        start = time.perf_counter()
+        k = min(self.processor.max_tokens_to_check, scores.size(-1))
+        top = scores.topk(k=k, dim=-1)
+        scores = self.processor(input_ids, scores)
+        rejected = torch.isfinite(top.values) & ~torch.isfinite(
+            scores.gather(-1, top.indices))
+        self.usage.rejected += int(rejected.sum())
+        self.usage.calls += 1
+        self.usage.seconds += time.perf_counter() - start
+        return scores
+
+
+def picard_usage(model) -> PicardUsage:
+    """
+    Instruments the PICARD logits processor that `with_picard` adds to every generation
+    of `model`, once per model, and returns the usage it records.
+    """
+    usage = getattr(model, "_picard_usage", None)
+    if usage is not None:
+        return usage
+    usage = model._picard_usage = PicardUsage()
+    get_logits_processor = model._get_logits_processor
+
+    def _get_logits_processor(*args, **kwargs) -> LogitsProcessorList:
+        return LogitsProcessorList(
+            CountingPicardLogitsProcessor(processor, usage) if isinstance(
+                processor, PicardLogitsProcessor) else processor
+            for processor in get_logits_processor(*args, **kwargs)
+        )
+
+    model._get_logits_processor = _get_logits_processor
+    return usage
+
+
+class Text2SQLServingPipeline(Text2SQLGenerationPipeline):
+    """
+    Text2SQLGenerationPipeline that takes schemas, their serialization and their token ids
+    from a shared `SchemaCache` instead of re-reading and re-tokenizing them per question.
+
+    The question and the serialized schema are tokenized separately and their token ids
+    concatenated, which is equivalent to tokenizing the joined input for tokenizers that
+    pre-tokenize on whitespace, like the T5 sentencepiece tokenizers.
+    """
+
+    def __init__(self, *args, schemas: SchemaCache, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schemas = schemas
+        self.picard_usage = picard_usage(self.model)
+
+    def _serialize(self, input: Text2SQLInput) -> Tuple[SchemaEntry, str]:
+        entry = self.schemas.get(input.db_id)
+        if hasattr(self.model, "add_schema"):
+            self.model.add_schema(db_id=input.db_id, db_info=entry.schema)
+        serialized_schema = self.schemas.serialize(
+            entry,
+            question=input.utterance,
+            with_db_content=self.schema_serialization_with_db_content,
+            schema_serialization_type=self.schema_serialization_type,
+            schema_serialization_randomized=self.schema_serialization_randomized,
+            schema_serialization_with_db_id=self.schema_serialization_with_db_id,
+            normalize_query=self.normalize_query,
+        )
+        return entry, serialized_schema
+
+    def _pre_process(self, input: Text2SQLInput) -> str:
+        prefix = self.prefix if self.prefix is not None else ""
+        _, serialized_schema = self._serialize(input)
+        return spider_get_input(question=input.utterance, serialized_schema=serialized_schema, prefix=prefix)
+
+    def encode(self, input: Text2SQLInput, timings: Optional[Dict[str, float]] = None) -> List[int]:
+        """
+        Token ids of the model input for `input`. When given, `timings` accumulates the
+        seconds spent serializing the schema and tokenizing.
+        """
+        start = time.perf_counter()
+        prefix = self.prefix if self.prefix is not None else ""
+        entry, serialized_schema = self._serialize(input)
+        serialized = time.perf_counter()
+        question_ids = self.tokenizer(
+            prefix + input.utterance.strip(), add_special_tokens=False)["input_ids"]
+        schema_ids = self.schemas.tokenize(
+            entry, self.tokenizer, serialized_schema.strip())
+        token_ids = self.tokenizer.build_inputs_with_special_tokens(
+            question_ids + schema_ids)
+        if timings is not None:
+            timings["schema"] = timings.get("schema", 0.0) + serialized - start
+            timings["tokenize"] = timings.get(
+                "tokenize", 0.0) + time.perf_counter() - serialized
+        return token_ids
+
+    def collate(self, token_ids: List[List[int]]) -> BatchEncoding:
+        return self.tokenizer.pad({"input_ids": token_ids}, return_tensors=self.framework)
+
+    def _parse_and_tokenize(self, *args, truncation) -> BatchEncoding:
+        if isinstance(args[0], list):
+            inputs = args[0]
+        elif isinstance(args[0], Text2SQLInput):
+            inputs = [args[0]]
+        else:
+            raise ValueError(
+                " `inputs`: {} have the wrong format. The should be either of type `Text2SQLInput` or type `List[Text2SQLInput]`".format(
+                    args[0]
+                )
+            )
+        return self.collate([self.encode(input) for input in inputs])
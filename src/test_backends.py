@@ -0,0 +1,112 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import torch
+from seq2seq.utils import picard_model_wrapper
+from seq2seq.utils.picard_model_wrapper import PicardArguments, PicardLogitsProcessor, with_picard
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from transformers import PreTrainedTokenizerFast, T5Config
+
+from backends import INFERENCE_BACKENDS, check_backend, load_model
+from schema_cache import SchemaCache
+from serving_pipeline import CountingPicardLogitsProcessor, Text2SQLServingPipeline
+
+
+class TestCheckBackend(unittest.TestCase):
+
+    def test_backends(self):
+        for backend in INFERENCE_BACKENDS:
+            check_backend(backend)
+        with self.assertRaises(ValueError):
+            check_backend('fp16')
+
+
+class FakeORTModel:
+    """
+    Stands in for optimum's ORTModelForSeq2SeqLM: no torch module, with the `generate` of
+    transformers, which asks `_get_logits_processor` for the processors to apply.
+    """
+
+    def __init__(self, config, **kwargs):
+        self.config = config
+        self.loaded_with = kwargs
+        self.logits_processor = None
+
+    @classmethod
+    def from_pretrained(cls, model_path, config=None, **kwargs):
+        return cls(config, **kwargs)
+
+    def _get_logits_processor(self, logits_processor, **kwargs):
+        return logits_processor
+
+    def generate(self, input_ids, logits_processor=None, **kwargs):
+        self.logits_processor = self._get_logits_processor(logits_processor=logits_processor)
+        return input_ids
+
+
+class FakePicardClient:
+
+    def __init__(self):
+        self.tokenizers = []
+        self.schemas = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def registerTokenizer(self, json_str):
+        self.tokenizers.append(json_str)
+
+    async def registerSQLSchema(self, db_id, sql_schema):
+        self.schemas.append(db_id)
+
+
+class TestOnnxWithPicard(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakePicardClient()
+        patch = mock.patch.object(picard_model_wrapper, 'get_client',
+                                  lambda *args, **kwargs: self.client, create=True)
+        patch.start()
+        self.addCleanup(patch.stop)
+        patch = mock.patch('backends._ort_model_cls', return_value=FakeORTModel)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.tokenizer = PreTrainedTokenizerFast(
+            tokenizer_object=Tokenizer(WordLevel({'<pad>': 0, '</s>': 1, '<unk>': 2}, unk_token='<unk>')),
+            pad_token='<pad>', eos_token='</s>', unk_token='<unk>')
+
+    def test_builds_a_pipeline(self):
+        picard_args = PicardArguments(use_picard=True, launch_picard=False)
+        model = load_model(
+            lambda model_cls: with_picard(model_cls=model_cls, picard_args=picard_args, tokenizer=self.tokenizer),
+            'tscholak/1zha5ono', config=T5Config(eos_token_id=1), backend='onnx')
+        self.assertIsInstance(model, FakeORTModel)
+        self.assertEqual(model.loaded_with, {'export': True, 'use_cache': True})
+        self.assertEqual(len(self.client.tokenizers), 1)
+
+        model.add_schema(db_id='concert_singer', db_info={
+            'db_table_names': ['singer'],
+            'db_column_names': {'table_id': [-1, 0], 'column_name': ['*', 'name']},
+            'db_column_types': ['text', 'text'],
+            'db_primary_keys': {'column_id': []},
+            'db_foreign_keys': {'column_id': [], 'other_column_id': []},
+        })
+        self.assertEqual(self.client.schemas, ['concert_singer'])
+
+        with tempfile.TemporaryDirectory() as db_path:
+            pipe = Text2SQLServingPipeline(model=model, tokenizer=self.tokenizer, db_path=db_path,
+                                           schemas=SchemaCache(db_path))
+        self.assertIs(pipe.model, model)
+        model.generate(torch.tensor([[1]]))
+        processor, = model.logits_processor
+        self.assertIsInstance(processor, CountingPicardLogitsProcessor)
+        self.assertIsInstance(processor.processor, PicardLogitsProcessor)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+from batch_questions import BatchQuestion, completed, parse_questions, read_jsonl
+
+
+class TestParseQuestions(unittest.TestCase):
+
+    def test_pairs_and_objects(self):
+        self.assertEqual(parse_questions([['pets_1', 'how many pets?'], {'db_id': 'pets_1', 'question': 'oldest pet?', 'id': 7}]), [
+            BatchQuestion('pets_1', 'how many pets?'), BatchQuestion('pets_1', 'oldest pet?', 7)])
+
+    def test_rejects_incomplete_questions(self):
+        for items in ({'db_id': 'pets_1'}, [['pets_1']], [{'db_id': 'pets_1'}], [['', 'how many pets?']]):
+            with self.assertRaises(ValueError):
+                parse_questions(items)
+
+    def test_jsonl(self):
+        data = b'["pets_1", "how many pets?"]\n\n{"db_id": "pets_1", "question": "oldest pet?"}\n'
+        self.assertEqual(len(read_jsonl(data)), 2)
+        with self.assertRaises(ValueError):
+            read_jsonl(b'["pets_1", "how many pets?"]\nnot json\n')
+
+
+class TestCompleted(unittest.TestCase):
+
+    def test_order_and_window(self):
+        running, most = 0, 0
+
+        async def answer(delay):
+            nonlocal running, most
+            running += 1
+            most = max(most, running)
+            await asyncio.sleep(delay)
+            running -= 1
+            return delay
+
+        async def collect():
+            return [delay async for delay in completed([0.03, 0.01, 0.02, 0.0], answer, window=2)]
+
+        answers = asyncio.run(collect())
+        self.assertEqual(sorted(answers), [0.0, 0.01, 0.02, 0.03])
+        self.assertEqual(answers[0], 0.01)
+        self.assertEqual(most, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import threading
+import time
+import unittest
+from sqlite3 import OperationalError
+from types import SimpleNamespace
+
+import torch
+from seq2seq.utils.pipeline import Text2SQLInput
+
+from batching import MicroBatcher, generate_batch
+from executors import Overloaded
+
+
+class StubPipe:
+    """
+    Stands in for Text2SQLServingPipeline: the question "7" is encoded as [7], and its
+    generated sequences are [7, 1], [7, 2], ... decoded as "7.1", "7.2", ...
+    """
+
+    def __init__(self):
+        self.tokenizer = SimpleNamespace(pad_token_id=0)
+        self.picard_usage = SimpleNamespace(
+            reset=lambda: None, seconds=0.0, rejected=0)
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def encode(self, input, timings=None):
+        if input.db_id == 'missing':
+            raise OperationalError('unable to open database file')
+        return [int(input.utterance)]
+
+    def collate(self, token_ids):
+        return token_ids
+
+    def forward(self, model_inputs, num_return_sequences=1):
+        self.release.wait()
+        self.batches.append(len(model_inputs))
+        # (batch, num_return_sequences, length), as Text2TextGenerationPipeline._forward
+        return {'output_ids': torch.tensor([[[token, sequence + 1] for sequence in range(num_return_sequences)]
+                                            for token, in model_inputs])}
+
+    def postprocess(self, model_outputs):
+        return [{'generated_text': '.'.join(str(token) for token in output_ids.tolist())}
+                for output_ids in model_outputs['output_ids'][0]]
+
+
+def question(i, db_id='pets_1'):
+    return Text2SQLInput(utterance=str(i), db_id=db_id)
+
+
+def settled(batcher, timeout=5):
+    # futures run their callbacks, which count them as done, after waking up their waiters
+    deadline = time.monotonic() + timeout
+    while batcher.pending and time.monotonic() < deadline:
+        time.sleep(0.001)
+    return batcher.pending == 0
+
+
+class TestGenerateBatch(unittest.TestCase):
+
+    def test_bad_input_only_fails_itself(self):
+        pipe = StubPipe()
+        timings = {}
+        results = generate_batch(
+            pipe, [question(1), question(2, 'missing'), question(3)], 1, timings)
+        self.assertEqual(results[0], [{'generated_text': '1.1'}])
+        self.assertIsInstance(results[1], OperationalError)
+        self.assertEqual(results[2], [{'generated_text': '3.1'}])
+        self.assertEqual(pipe.batches, [2])
+        self.assertEqual(timings['tokens'], 4)
+
+    def test_fans_out_return_sequences(self):
+        results = generate_batch(StubPipe(), [question(1), question(2)], 3)
+        self.assertEqual([[output['generated_text'] for output in result] for result in results], [
+                         ['1.1', '1.2', '1.3'], ['2.1', '2.2', '2.3']])
+
+
+class TestMicroBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.pipe = StubPipe()
+
+    def batcher(self, **kwargs):
+        batcher = MicroBatcher(self.pipe, **kwargs)
+        self.addCleanup(batcher.close)
+        return batcher
+
+    def test_coalesces_up_to_max_batch_size(self):
+        batcher = self.batcher(max_batch_size=4, max_wait_ms=200)
+        futures = [batcher.submit(question(i)) for i in range(1, 7)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [
+                         [{'generated_text': f'{i}.1'}] for i in range(1, 7)])
+        self.assertEqual(self.pipe.batches, [4, 2])
+        self.assertTrue(settled(batcher))
+
+    def test_max_wait(self):
+        batcher = self.batcher(max_batch_size=4, max_wait_ms=1)
+        self.assertEqual(batcher(question(1)), [{'generated_text': '1.1'}])
+        self.assertEqual(self.pipe.batches, [1])
+
+    def test_bad_db_id_fails_only_its_future(self):
+        batcher = self.batcher(max_batch_size=4, max_wait_ms=200)
+        good, bad = batcher.submit(question(1)), batcher.submit(
+            question(2, 'missing'))
+        self.assertEqual(good.result(timeout=5), [{'generated_text': '1.1'}])
+        with self.assertRaises(OperationalError):
+            bad.result(timeout=5)
+        self.assertEqual(self.pipe.batches, [1])
+
+    def test_return_sequences(self):
+        batcher = self.batcher(num_return_sequences=2, max_wait_ms=1)
+        self.assertEqual(batcher(question(5)), [
+                         {'generated_text': '5.1'}, {'generated_text': '5.2'}])
+
+    def test_overloaded_at_max_pending(self):
+        self.pipe.release.clear()
+        batcher = self.batcher(max_batch_size=1, max_wait_ms=1, max_pending=2)
+        futures = [batcher.submit(question(1)), batcher.submit(question(2))]
+        with self.assertRaises(Overloaded):
+            batcher.submit(question(3))
+        self.pipe.release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.assertTrue(settled(batcher))
+        batcher.submit(question(3)).result(timeout=5)
+
+    def test_close(self):
+        batcher = MicroBatcher(self.pipe, max_wait_ms=1)
+        future = batcher.submit(question(1))
+        batcher.close()
+        # questions submitted before closing are still answered
+        self.assertEqual(future.result(timeout=0), [
+                         {'generated_text': '1.1'}])
+        self.assertFalse(batcher._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
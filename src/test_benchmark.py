@@ -0,0 +1,61 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from benchmark import QUESTIONS, compare, execution_match, make_databases, normalize_query, percentile, summarize
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3, 1, 2], 100), 3)
+        self.assertEqual(percentile([3, 1, 2], 0), 1)
+
+    def test_summarize(self):
+        summary = summarize([0.1, 0.2, 0.3, 0.4], elapsed=2.0, errors=1)
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['errors'], 1)
+        self.assertAlmostEqual(summary['p50_ms'], 200)
+        self.assertAlmostEqual(summary['throughput_rps'], 2)
+
+    def test_gold_queries_run_on_generated_databases(self):
+        with tempfile.TemporaryDirectory() as db_path:
+            make_databases(db_path, rows_per_table=50)
+            for db_id, _, query in QUESTIONS:
+                conn = sqlite3.connect(os.path.join(db_path, db_id, f'{db_id}.sqlite'))
+                conn.execute(query).fetchall()
+                conn.close()
+
+    def test_generated_databases_are_reproducible(self):
+        contents = []
+        for _ in range(2):
+            with tempfile.TemporaryDirectory() as db_path:
+                make_databases(db_path, rows_per_table=50, seed=1)
+                conn = sqlite3.connect(os.path.join(db_path, 'pets_1', 'pets_1.sqlite'))
+                contents.append(conn.execute('SELECT * FROM pets').fetchall())
+                conn.close()
+        self.assertEqual(contents[0], contents[1])
+
+    def test_matches(self):
+        self.assertEqual(normalize_query('pets_1 | SELECT  count(*) FROM Pets'),
+                         'select count(*) from pets')
+        with tempfile.TemporaryDirectory() as db_path:
+            make_databases(db_path, rows_per_table=50)
+            gold = 'SELECT max(weight), pet_type FROM pets GROUP BY pet_type'
+            self.assertTrue(execution_match(
+                db_path, 'pets_1', 'pets_1 | SELECT max(weight), pet_type FROM pets GROUP BY pet_type ORDER BY pet_type', gold))
+            self.assertFalse(execution_match(db_path, 'pets_1', 'SELECT count(*) FROM pets', gold))
+            self.assertFalse(execution_match(db_path, 'pets_1', 'SELECT FROM', gold))
+
+    def test_compare(self):
+        lines = compare({'sql': {'p50_ms': 2.0}}, {'sql': {'p50_ms': 1.0}, 'new': 1.0})
+        self.assertEqual(lines, ['sql.p50_ms: 2.00 -> 1.00 (-50.0%)'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from db_catalog import DatabaseCatalog
+
+
+class TestDatabaseCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.write('singers', 'CREATE TABLE singer (id INTEGER, name TEXT)')
+        self.write('pets', 'CREATE TABLE pet (id INTEGER); CREATE TABLE owner (id INTEGER, pet_id INTEGER, name TEXT)')
+        os.makedirs(os.path.join(self.dir.name, 'empty'))
+        self.catalog = DatabaseCatalog(self.dir.name)
+        self.catalog.refresh()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, db_id, script):
+        os.makedirs(os.path.join(self.dir.name, db_id), exist_ok=True)
+        path = os.path.join(self.dir.name, db_id, f'{db_id}.sqlite')
+        tmp = f'{path}.tmp'
+        conn = sqlite3.connect(tmp)
+        conn.executescript(script)
+        conn.close()
+        os.replace(tmp, path)
+
+    def test_describes_databases(self):
+        self.assertEqual([entry.db_id for entry in self.catalog.entries()], [
+                         'pets', 'singers'])
+        pets = self.catalog.get('pets')
+        self.assertEqual((pets.tables, pets.columns), (2, 4))
+        self.assertEqual(len(pets.sha256), 64)
+        self.assertEqual(pets.size, os.path.getsize(pets.path))
+        self.assertIsNone(self.catalog.get('empty'))
+        self.assertIsNone(self.catalog.get('../pets'))
+
+    def test_refresh(self):
+        self.write('cars', 'CREATE TABLE car (id INTEGER)')
+        time.sleep(0.01)
+        self.write('singers', 'CREATE TABLE singer (id INTEGER)')
+        os.remove(os.path.join(self.dir.name, 'pets', 'pets.sqlite'))
+        self.assertEqual(sorted(self.catalog.refresh()), ['cars', 'singers'])
+        self.assertEqual([entry.db_id for entry in self.catalog.entries()], [
+                         'cars', 'singers'])
+        self.assertEqual(self.catalog.get('singers').columns, 1)
+        self.assertEqual(self.catalog.refresh(), [])
+
+    def test_finds_databases_added_since_refresh(self):
+        self.write('cars', 'CREATE TABLE car (id INTEGER)')
+        self.assertEqual(self.catalog.get('cars').tables, 1)
+
+    def test_most_used(self):
+        for db_id in ('singers', 'singers', 'pets', 'unknown'):
+            self.catalog.record_use(db_id)
+        self.assertEqual(self.catalog.most_used(1), ['singers'])
+        self.catalog.save_usage()
+        self.assertEqual(DatabaseCatalog(self.dir.name).most_used(5), [])
+        reloaded = DatabaseCatalog(self.dir.name)
+        reloaded.refresh()
+        self.assertEqual(reloaded.most_used(5), ['singers', 'pets'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import io
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from db_files import fingerprint, sqlite_path, store_database
+
+
+class TestStoreDatabase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = sqlite_path(self.dir.name, 'concert_singer')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def database(self, rows):
+        source = os.path.join(self.dir.name, 'source.sqlite')
+        if os.path.exists(source):
+            os.remove(source)
+        conn = sqlite3.connect(source)
+        conn.execute('CREATE TABLE singer (id INTEGER)')
+        conn.executemany('INSERT INTO singer VALUES (?)', rows)
+        conn.commit()
+        conn.close()
+        with open(source, 'rb') as f:
+            return f.read()
+
+    def test_stores_and_skips_identical_content(self):
+        content = self.database([(1,), (2,)])
+        stored = store_database(io.BytesIO(content), self.path, chunk_size=1024)
+        self.assertTrue(stored.changed)
+        self.assertEqual(stored.size, len(content))
+        before = fingerprint(self.path)
+        stored = store_database(io.BytesIO(content), self.path, chunk_size=1024)
+        self.assertFalse(stored.changed)
+        self.assertEqual(fingerprint(self.path), before)
+        self.assertEqual(os.listdir(os.path.dirname(self.path)).count('concert_singer.sqlite'), 1)
+
+    def test_replaces_changed_content(self):
+        store_database(io.BytesIO(self.database([(1,)])), self.path)
+        stored = store_database(io.BytesIO(self.database([(1,), (2,)])), self.path)
+        self.assertTrue(stored.changed)
+        conn = sqlite3.connect(self.path)
+        self.assertEqual(conn.execute('SELECT count(*) FROM singer').fetchone(), (2,))
+        conn.close()
+
+    def test_rejects_invalid_content_and_keeps_the_stored_database(self):
+        content = self.database([(1,)])
+        store_database(io.BytesIO(content), self.path)
+        with self.assertRaises(ValueError):
+            store_database(io.BytesIO(b'not a database' * 100), self.path)
+        with self.assertRaises(ValueError):
+            store_database(io.BytesIO(content[:len(content) // 2]), self.path)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(self.path))),
+                         ['concert_singer.sqlite', 'concert_singer.sqlite.sha256'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from db_pool import ConnectionPool
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.sqlite')
+        self.write([(1,), (2,)])
+        self.pool = ConnectionPool(max_idle=2)
+
+    def tearDown(self):
+        self.pool.close()
+        self.dir.cleanup()
+
+    def write(self, rows):
+        tmp = f'{self.path}.tmp'
+        conn = sqlite3.connect(tmp)
+        conn.execute('CREATE TABLE singer (id INTEGER)')
+        conn.executemany('INSERT INTO singer VALUES (?)', rows)
+        conn.commit()
+        conn.close()
+        os.replace(tmp, self.path)
+
+    def test_reuses_connections(self):
+        with self.pool.connection(self.path) as first:
+            pass
+        with self.pool.connection(self.path) as second:
+            self.assertIs(first, second)
+            self.assertEqual(second.execute(
+                'SELECT COUNT(*) FROM singer').fetchone(), (2,))
+
+    def test_connections_are_read_only(self):
+        with self.pool.connection(self.path) as conn:
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM singer')
+
+    def test_replaced_file_gets_new_connections(self):
+        with self.pool.connection(self.path) as first:
+            pass
+        self.write([(1,), (2,), (3,)])
+        with self.pool.connection(self.path) as second:
+            self.assertIsNot(first, second)
+            self.assertEqual(second.execute(
+                'SELECT COUNT(*) FROM singer').fetchone(), (3,))
+
+    def test_invalidate_closes_checked_out_connections(self):
+        with self.pool.connection(self.path) as conn:
+            self.pool.invalidate(self.path)
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
+
+    def test_missing_database(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            with self.pool.connection(os.path.join(self.dir.name, 'missing.sqlite')):
+                pass
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import sqlite3
+import unittest
+
+from execution import QueryTimeout, ResultCursors, execute_query, iter_query
+
+
+class TestExecution(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE track (id INTEGER)')
+        self.conn.executemany('INSERT INTO track VALUES (?)',
+                              [(i,) for i in range(100)])
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_row_cap(self):
+        result = execute_query(
+            self.conn, 'SELECT id FROM track ORDER BY id', max_rows=10)
+        self.assertEqual(result.rows, [(i,) for i in range(10)])
+        self.assertTrue(result.truncated)
+
+    def test_offset(self):
+        result = execute_query(
+            self.conn, 'SELECT id FROM track ORDER BY id', max_rows=10, offset=95)
+        self.assertEqual(result.rows, [(i,) for i in range(95, 100)])
+        self.assertFalse(result.truncated)
+
+    def test_iter_query(self):
+        rows = list(iter_query(
+            self.conn, 'SELECT id FROM track', max_rows=42, chunk_size=5))
+        self.assertEqual(len(rows), 42)
+
+    def test_timeout(self):
+        query = 'SELECT COUNT(*) FROM track a, track b, track c, track d'
+        with self.assertRaises(QueryTimeout):
+            execute_query(self.conn, query, max_rows=1, timeout=0.05)
+        # the progress handler is removed afterwards
+        self.assertEqual(execute_query(
+            self.conn, 'SELECT 1', max_rows=1).rows, [(1,)])
+
+
+class TestResultCursors(unittest.TestCase):
+
+    def test_round_trip(self):
+        cursors = ResultCursors()
+        cursor = cursors.encode('/database/a/a.sqlite', 'SELECT 1', 10, 10)
+        self.assertEqual(cursors.decode(cursor), {
+            'path': '/database/a/a.sqlite', 'query': 'SELECT 1', 'offset': 10, 'limit': 10})
+
+    def test_rejects_foreign_cursors(self):
+        cursor = ResultCursors().encode('/database/a/a.sqlite', 'SELECT 1', 10, 10)
+        with self.assertRaises(ValueError):
+            ResultCursors().decode(cursor)
+
+
+if __name__ == '__main__':
+    unittest.main()
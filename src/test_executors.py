@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from executors import BoundedExecutor, Overloaded, iterate_in, physical_cores
+
+
+class TestBoundedExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=2)
+        self.executor = BoundedExecutor(self.pool, max_pending=2)
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+
+    def test_overloaded_at_max_pending(self):
+        release = threading.Event()
+        futures = [self.executor.submit(release.wait) for _ in range(2)]
+        self.assertEqual(self.executor.pending, 2)
+        with self.assertRaises(Overloaded):
+            self.executor.submit(release.wait)
+        release.set()
+        for future in futures:
+            future.result(timeout=5)
+        self.pool.shutdown(wait=True)
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_failed_tasks_are_no_longer_pending(self):
+        def fail():
+            raise ValueError('failed')
+
+        async def run():
+            with self.assertRaises(ValueError):
+                await self.executor.run(fail)
+
+        for _ in range(3):
+            asyncio.run(run())
+        self.pool.shutdown(wait=True)
+        self.assertEqual(self.executor.pending, 0)
+
+    def test_iterate_in(self):
+        async def collect():
+            return [item async for item in iterate_in(self.executor, iter(range(5)))]
+
+        self.assertEqual(asyncio.run(collect()), [0, 1, 2, 3, 4])
+
+
+class TestPhysicalCores(unittest.TestCase):
+
+    def test_at_least_one(self):
+        self.assertGreaterEqual(physical_cores(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
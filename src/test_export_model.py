@@ -0,0 +1,24 @@
+import json
+import os
+import tempfile
+import unittest
+
+from export_model import MANIFEST, read_manifest
+
+
+class TestReadManifest(unittest.TestCase):
+
+    def test_reads_manifest(self):
+        with tempfile.TemporaryDirectory() as artifact_path:
+            with open(os.path.join(artifact_path, MANIFEST), 'w') as f:
+                json.dump({'model_path': 'tscholak/1zha5ono', 'weights': 'pytorch'}, f)
+            self.assertEqual(read_manifest(artifact_path)['model_path'], 'tscholak/1zha5ono')
+
+    def test_rejects_directories_without_manifest(self):
+        with tempfile.TemporaryDirectory() as artifact_path:
+            with self.assertRaises(ValueError):
+                read_manifest(artifact_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+from metrics import MetricsRegistry, labels, record_timing, request_timings, server_timing
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = MetricsRegistry(namespace='test')
+
+    def test_histogram(self):
+        histogram = self.metrics.histogram('stage_seconds', 'Stages.', buckets=(0.1, 1))
+        histogram.observe(0.05, stage='sql')
+        histogram.observe(0.5, stage='sql')
+        histogram.observe(5, stage='sql')
+        lines = self.metrics.render().splitlines()
+        self.assertIn('# TYPE test_stage_seconds histogram', lines)
+        self.assertIn('test_stage_seconds_bucket{stage="sql",le="0.1"} 1', lines)
+        self.assertIn('test_stage_seconds_bucket{stage="sql",le="1"} 2', lines)
+        self.assertIn('test_stage_seconds_bucket{stage="sql",le="+Inf"} 3', lines)
+        self.assertIn('test_stage_seconds_sum{stage="sql"} 5.55', lines)
+        self.assertIn('test_stage_seconds_count{stage="sql"} 3', lines)
+
+    def test_counters_and_gauges(self):
+        counter = self.metrics.counter('tokens_total', 'Tokens.')
+        counter.inc(3)
+        counter.inc(2)
+        self.metrics.gauge('queue_depth', 'Queues.', lambda: {labels(queue='sql'): 4})
+        lines = self.metrics.render().splitlines()
+        self.assertIn('test_tokens_total 5', lines)
+        self.assertIn('test_queue_depth{queue="sql"} 4', lines)
+
+    def test_duplicate_names(self):
+        self.metrics.counter('tokens_total', 'Tokens.')
+        with self.assertRaises(ValueError):
+            self.metrics.counter('tokens_total', 'Tokens.')
+
+    def test_server_timing(self):
+        record_timing('sql', 1.0)
+        with request_timings() as timings:
+            record_timing('sql', 0.001)
+            record_timing('sql', 0.002)
+        self.assertEqual(server_timing(timings), 'sql;dur=3.0')
+
+
+if __name__ == '__main__':
+    unittest.main()
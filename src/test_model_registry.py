@@ -0,0 +1,68 @@
+import threading
+import unittest
+
+from model_registry import ModelKey, ModelRegistry
+
+
+def key(name):
+    return ModelKey(name, -1, (512, 4, 1, 0.0))
+
+
+class TestModelRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ModelRegistry(memory_budget=10, weigh=len)
+
+    def test_loads_lazily_once(self):
+        loads = []
+
+        def load():
+            loads.append(1)
+            return "abc"
+
+        self.assertEqual(self.registry.get(key("a"), load), "abc")
+        self.assertEqual(self.registry.get(key("a"), load), "abc")
+        self.assertEqual(len(loads), 1)
+
+    def test_evicts_least_recently_used(self):
+        self.registry.get(key("a"), lambda: "aaaa")
+        self.registry.get(key("b"), lambda: "bbbb")
+        self.registry.get(key("a"), lambda: "aaaa")
+        self.registry.get(key("c"), lambda: "cccc")
+        self.assertIn(key("a"), self.registry)
+        self.assertNotIn(key("b"), self.registry)
+        self.assertIn(key("c"), self.registry)
+        self.assertEqual(self.registry.resident_bytes, 8)
+
+    def test_pinned_entries_are_kept(self):
+        self.registry.add(key("a"), "aaaaaa", pinned=True)
+        self.registry.get(key("b"), lambda: "bbbbbb")
+        self.registry.get(key("c"), lambda: "cccccc")
+        self.assertIn(key("a"), self.registry)
+        self.assertNotIn(key("b"), self.registry)
+        self.assertIn(key("c"), self.registry)
+
+    def test_concurrent_gets_share_a_single_load(self):
+        started = threading.Event()
+        release = threading.Event()
+        loads = []
+
+        def load():
+            loads.append(1)
+            started.set()
+            release.wait()
+            return "abc"
+
+        threads = [threading.Thread(target=self.registry.get, args=(key("a"), load))
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        started.wait()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(loads), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from query_guard import QueryGuard, QueryRejected
+
+
+class TestQueryGuard(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('CREATE TABLE track (id INTEGER PRIMARY KEY, album_id INTEGER, name TEXT)')
+        self.conn.execute('CREATE TABLE album (id INTEGER PRIMARY KEY, title TEXT)')
+        self.conn.executemany('INSERT INTO track VALUES (?, ?, ?)',
+                              [(i, i % 10, f'track {i}') for i in range(1000)])
+        self.conn.executemany('INSERT INTO album VALUES (?, ?)', [(i, f'album {i}') for i in range(10)])
+        self.guard = QueryGuard(max_cost=5000)
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_runs_cheap_queries_unchanged(self):
+        for query in ['SELECT name FROM track',
+                      'SELECT T1.name FROM track AS T1 JOIN album AS T2 ON T1.album_id = T2.id',
+                      'SELECT name FROM track WHERE id = 3']:
+            self.assertEqual(self.guard.check(self.conn, query, max_rows=11), query)
+
+    def test_rewrites_streaming_queries_with_a_limit(self):
+        query = 'SELECT T1.name, T2.name FROM track AS T1, track AS T2;'
+        self.assertEqual(self.guard.check(self.conn, query, max_rows=11),
+                         'SELECT T1.name, T2.name FROM track AS T1, track AS T2 LIMIT 11')
+
+    def test_rejects_expensive_blocking_queries(self):
+        for query in ['SELECT count(*) FROM track AS T1, track AS T2',
+                      'SELECT T1.name FROM track AS T1, track AS T2 ORDER BY T2.name',
+                      'SELECT T1.name FROM track AS T1, track AS T2 LIMIT 5000000']:
+            with self.assertRaises(QueryRejected) as e:
+                self.guard.check(self.conn, query, max_rows=11)
+            self.assertIn('cartesian product of', e.exception.args[0])
+
+    def test_rejects_invalid_queries(self):
+        with self.assertRaises(QueryRejected):
+            self.guard.check(self.conn, 'SELECT nope FROM track', max_rows=11)
+
+    def test_index_lookups_are_cheap(self):
+        self.conn.execute('CREATE INDEX track_album_id ON track (album_id)')
+        query = 'SELECT T1.name FROM album AS T2 JOIN track AS T1 ON T1.album_id = T2.id ORDER BY T1.name'
+        self.assertEqual(self.guard.check(self.conn, query, max_rows=11), query)
+
+    def test_sparse_keys_are_not_rows(self):
+        self.conn.execute('CREATE TABLE singer (id INTEGER PRIMARY KEY, name TEXT)')
+        self.conn.executemany('INSERT INTO singer VALUES (?, ?)',
+                              [(i * 10 ** 9, f'singer {i}') for i in range(49)])
+        for query in ['SELECT count(*) FROM singer', 'SELECT name FROM singer ORDER BY name',
+                      'SELECT name FROM singer']:
+            self.assertEqual(self.guard.check(self.conn, query, max_rows=11), query)
+        self.assertEqual(self.guard.cost(self.conn, 'SELECT name FROM singer').rows, 49)
+
+    def test_analyzed_sizes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tracks.sqlite')
+            conn = sqlite3.connect(path)
+            # the backup waits for open transactions
+            self.conn.commit()
+            self.conn.backup(conn)
+            conn.execute('CREATE INDEX track_album_id ON track (album_id)')
+            conn.execute('ANALYZE')
+            conn.execute("UPDATE sqlite_stat1 SET stat = '100000 10000' WHERE tbl = 'track'")
+            conn.commit()
+            # the statistics are read when the connection is opened
+            conn.close()
+            conn = sqlite3.connect(path)
+            try:
+                self.assertEqual(self.guard.cost(conn, 'SELECT name FROM track').rows, 100000)
+            finally:
+                conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
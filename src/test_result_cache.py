@@ -0,0 +1,52 @@
+import unittest
+
+from result_cache import ResultCache, ResultKey, normalize_question
+
+
+def key(question, path='/database/chinook/chinook.sqlite'):
+    return ResultKey(path, normalize_question(question), 'tscholak/1zha5ono', (512, 4, 1, 0.0, 1))
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.cache = ResultCache(max_entries=2, ttl=10, clock=lambda: self.now)
+
+    def test_hit_after_put(self):
+        self.assertIsNone(self.cache.get(key('how many singers?'), (1, 1, 1)))
+        self.cache.put(key('how many singers?'), (1, 1, 1), ['SELECT 1'])
+        self.assertEqual(self.cache.get(
+            key('  how   many singers? '), (1, 1, 1)), ['SELECT 1'])
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_changed_database_is_a_miss(self):
+        self.cache.put(key('how many singers?'), (1, 1, 1), ['SELECT 1'])
+        self.assertIsNone(self.cache.get(key('how many singers?'), (1, 2, 1)))
+        self.assertEqual(self.cache.stats()['invalidations'], 1)
+
+    def test_expiration(self):
+        self.cache.put(key('how many singers?'), (1, 1, 1), ['SELECT 1'])
+        self.now = 11
+        self.assertIsNone(self.cache.get(key('how many singers?'), (1, 1, 1)))
+        self.assertEqual(self.cache.stats()['expirations'], 1)
+
+    def test_eviction(self):
+        self.cache.put(key('a'), (1, 1, 1), 'a')
+        self.cache.put(key('b'), (1, 1, 1), 'b')
+        self.cache.get(key('a'), (1, 1, 1))
+        self.cache.put(key('c'), (1, 1, 1), 'c')
+        self.assertIsNone(self.cache.get(key('b'), (1, 1, 1)))
+        self.assertEqual(self.cache.get(key('a'), (1, 1, 1)), 'a')
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_invalidate_path(self):
+        self.cache.put(key('a'), (1, 1, 1), 'a')
+        self.cache.put(key('b', path='/database/other/other.sqlite'), (1, 1, 1), 'b')
+        self.cache.invalidate('/database/chinook/chinook.sqlite')
+        self.assertEqual(self.cache.stats()['size'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from seq2seq.utils.bridge_content_encoder import get_database_matches
+
+from db_files import fingerprint, sqlite_path
+from value_index import ValueIndex, build_value_index, word_trigrams
+
+
+class TestValueIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = self.dir.name
+        os.makedirs(os.path.join(self.db_path, 'concert_singer'))
+        self.path = sqlite_path(self.db_path, 'concert_singer')
+        conn = sqlite3.connect(self.path)
+        conn.executescript(
+            '''
+            CREATE TABLE singer (singer_id INTEGER, name TEXT, country TEXT);
+            INSERT INTO singer VALUES (1, 'Joe Sharp', 'Netherlands'), (2, 'Timbaland', 'United States'),
+                (3, 'Justin Brown', 'France'), (4, 'Rose White', 'United States'), (5, 'John Nizinik', 'France');
+            '''
+        )
+        conn.close()
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_word_trigrams(self):
+        self.assertEqual(word_trigrams('Go'), {'  g', ' go', 'go '})
+
+    def test_build(self):
+        stats = build_value_index(
+            self.db_path, 'concert_singer', max_values_per_column=3)
+        # singer_id holds no text; name is truncated to 3 values, country has 3 distinct values
+        self.assertEqual((stats.columns, stats.values, stats.truncated_columns), (3, 6, 1))
+        index = ValueIndex.open(self.db_path, 'concert_singer', fingerprint(self.path))
+        meta = index.stats()
+        self.assertEqual(meta['fingerprint'], ':'.join(map(str, fingerprint(self.path))))
+        self.assertEqual(int(meta['values']), 6)
+
+    def test_stale_index_is_ignored(self):
+        build_value_index(self.db_path, 'concert_singer')
+        stale = fingerprint(self.path)
+        conn = sqlite3.connect(self.path)
+        conn.execute("INSERT INTO singer VALUES (6, 'Tribal King', 'France')")
+        conn.commit()
+        conn.close()
+        if fingerprint(self.path) == stale:
+            self.skipTest('the file system does not tell the versions apart')
+        self.assertIsNone(ValueIndex.open(self.db_path, 'concert_singer', fingerprint(self.path)))
+        self.assertIsNone(ValueIndex.open(self.db_path, 'pets_1', fingerprint(self.path)))
+
+    def test_matches_like_the_column_scan(self):
+        build_value_index(self.db_path, 'concert_singer')
+        index = ValueIndex.open(self.db_path, 'concert_singer', fingerprint(self.path))
+        question = 'How many singers are from France?'
+        self.assertIn('France', index.candidates(question)[('singer', 'country')])
+        scanned = get_database_matches(
+            question=question, table_name='singer', column_name='country', db_path=self.path)
+        self.assertEqual(scanned, ['France'])
+        self.assertEqual(index.matches(question)[('singer', 'country')], scanned)
+
+
+if __name__ == '__main__':
+    unittest.main()
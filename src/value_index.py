@@ -0,0 +1,275 @@
+import fcntl
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from sqlite3 import OperationalError, connect
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from seq2seq.utils.bridge_content_encoder import get_matched_entries
+
+from db_files import Fingerprint, fingerprint, sqlite_path
+
+logger = logging.getLogger(__name__)
+
+WORD = re.compile(r"\w+")
+# SQLITE_MAX_VARIABLE_NUMBER is 999 on older builds
+MAX_QUERY_GRAMS = 900
+
+
+def value_index_path(db_path: str, db_id: str) -> str:
+    return f"{db_path}/{db_id}/{db_id}.values.sqlite"
+
+
+def word_trigrams(text: str) -> Set[str]:
+    """
+    Lowercased character trigrams of every word of `text`, padded like pg_trgm so that
+    words shorter than three characters still produce grams.
+    """
+    grams = set()
+    for word in WORD.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+@dataclass
+class ValueIndexStats:
+    db_id: str
+    columns: int
+    values: int
+    grams: int
+    truncated_columns: int
+    seconds: float
+
+
+def build_value_index(
+    db_path: str,
+    db_id: str,
+    max_values_per_column: int = 100000,
+    max_value_length: int = 128,
+    chunk_size: int = 10000,
+) -> ValueIndexStats:
+    """
+    Builds the trigram index of the text values of every column of a database, next to its
+    `.sqlite` file. Rows are streamed in chunks and at most `max_values_per_column` distinct
+    values of at most `max_value_length` characters are kept per column, so that memory use
+    does not depend on the size of the database.
+    """
+    start = time.perf_counter()
+    source = sqlite_path(db_path, db_id)
+    source_fingerprint = fingerprint(source)
+    target = value_index_path(db_path, db_id)
+    tmp = f"{target}.tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+
+    src = connect(f"file:{source}?mode=ro", uri=True)
+    dst = connect(tmp)
+    try:
+        dst.executescript(
+            """
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+            CREATE TABLE indexed_columns (column_id INTEGER PRIMARY KEY, table_name TEXT, column_name TEXT);
+            CREATE TABLE indexed_values (value_id INTEGER PRIMARY KEY, column_id INTEGER, value TEXT);
+            CREATE TABLE value_grams (gram TEXT, value_id INTEGER);
+            """
+        )
+        stats = ValueIndexStats(db_id=db_id, columns=0, values=0,
+                                grams=0, truncated_columns=0, seconds=0.0)
+        tables = [name for name, in src.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table_name in tables:
+            columns = [row[1] for row in src.execute(
+                f'PRAGMA table_info("{table_name}")')]
+            for column_name in columns:
+                stats.columns += 1
+                column_id = dst.execute(
+                    "INSERT INTO indexed_columns (table_name, column_name) VALUES (?, ?)",
+                    (table_name, column_name),
+                ).lastrowid
+                cursor = src.execute(
+                    f'SELECT DISTINCT "{column_name}" FROM "{table_name}" '
+                    f'WHERE typeof("{column_name}") = \'text\' AND length("{column_name}") <= ? LIMIT ?',
+                    (max_value_length, max_values_per_column + 1),
+                )
+                count, truncated = 0, False
+                rows = cursor.fetchmany(chunk_size)
+                while rows:
+                    if count + len(rows) > max_values_per_column:
+                        rows = rows[:max_values_per_column - count]
+                        truncated = True
+                    count += len(rows)
+                    values, grams = [], []
+                    for value, in rows:
+                        stats.values += 1
+                        values.append((stats.values, column_id, value))
+                        grams.extend((gram, stats.values)
+                                     for gram in word_trigrams(value))
+                    dst.executemany(
+                        "INSERT INTO indexed_values VALUES (?, ?, ?)", values)
+                    dst.executemany(
+                        "INSERT INTO value_grams VALUES (?, ?)", grams)
+                    stats.grams += len(grams)
+                    rows = [] if truncated else cursor.fetchmany(chunk_size)
+                stats.truncated_columns += truncated
+        dst.executescript(
+            """
+            CREATE INDEX value_grams_gram ON value_grams (gram);
+            CREATE TABLE gram_df (gram TEXT PRIMARY KEY, df INTEGER) WITHOUT ROWID;
+            INSERT INTO gram_df SELECT gram, COUNT(*) FROM value_grams GROUP BY gram;
+            """
+        )
+        stats.seconds = time.perf_counter() - start
+        dst.executemany(
+            "INSERT INTO meta VALUES (?, ?)",
+            [("fingerprint", ":".join(map(str, source_fingerprint)))] +
+            [(key, value) for key, value in asdict(stats).items()],
+        )
+        dst.commit()
+    finally:
+        src.close()
+        dst.close()
+    os.replace(tmp, target)
+    logger.warning(
+        f"Indexed {stats.values} values ({stats.grams} grams) of {stats.columns} columns of {db_id} in {stats.seconds:.2f}s")
+    return stats
+
+
+class ValueIndex:
+    """
+    Read access to the trigram index of a database's content.
+
+    Candidate values sharing trigrams with the question are looked up in the index and only
+    those are fuzzy matched against the question, instead of every distinct value of every
+    column.
+    """
+
+    def __init__(self, path: str, num_values: int, max_candidates: int = 2000, max_df_ratio: float = 0.05):
+        self.path = path
+        self.max_candidates = max_candidates
+        self.max_df = max(100, int(num_values * max_df_ratio))
+
+    @classmethod
+    def open(cls, db_path: str, db_id: str, source_fingerprint: Fingerprint, **kwargs) -> Optional["ValueIndex"]:
+        """
+        Returns the index of the database, or None if it is missing or was built from
+        another version of the database file.
+        """
+        path = value_index_path(db_path, db_id)
+        if not os.path.exists(path):
+            return None
+        try:
+            conn = connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                meta = dict(conn.execute("SELECT key, value FROM meta"))
+            finally:
+                conn.close()
+        except OperationalError as e:
+            logger.warning(f"Ignoring unreadable value index {path}: {e}")
+            return None
+        if meta.get("fingerprint") != ":".join(map(str, source_fingerprint)):
+            return None
+        return cls(path, num_values=int(meta["values"]), **kwargs)
+
+    def stats(self) -> dict:
+        conn = connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            return dict(conn.execute("SELECT key, value FROM meta"))
+        finally:
+            conn.close()
+
+    def candidates(self, question: str) -> Dict[Tuple[str, str], List[str]]:
+        grams = sorted(word_trigrams(question))[:MAX_QUERY_GRAMS]
+        if not grams:
+            return {}
+        placeholders = ", ".join("?" * len(grams))
+        conn = connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            rows = conn.execute(
+                f"""
+                SELECT c.table_name, c.column_name, v.value
+                FROM value_grams g
+                JOIN indexed_values v ON v.value_id = g.value_id
+                JOIN indexed_columns c ON c.column_id = v.column_id
+                WHERE g.gram IN (SELECT gram FROM gram_df WHERE gram IN ({placeholders}) AND df <= ?)
+                GROUP BY g.value_id
+                ORDER BY COUNT(*) DESC
+                LIMIT ?
+                """,
+                (*grams, self.max_df, self.max_candidates),
+            ).fetchall()
+        finally:
+            conn.close()
+        candidates: Dict[Tuple[str, str], List[str]] = {}
+        for table_name, column_name, value in rows:
+            candidates.setdefault((table_name, column_name), []).append(value)
+        return candidates
+
+    def matches(
+        self, question: str, top_k_matches: int = 2, match_threshold: float = 0.85
+    ) -> Dict[Tuple[str, str], List[str]]:
+        """
+        Database content matching the question, per (table_name, column_name), with the same
+        selection rules as `seq2seq.utils.bridge_content_encoder.get_database_matches`.
+        """
+        matches: Dict[Tuple[str, str], List[str]] = {}
+        for (table_name, column_name), values in self.candidates(question).items():
+            matched_entries = get_matched_entries(
+                s=question, field_values=values, m_theta=match_threshold, s_theta=match_threshold)
+            if not matched_entries:
+                continue
+            column_matches = []
+            for _match_str, (field_value, _s_match_str, match_score, s_match_score, _match_size) in matched_entries:
+                if "name" in column_name and match_score * s_match_score < 1:
+                    continue
+                column_matches.append(field_value.strip())
+                if len(column_matches) >= top_k_matches:
+                    break
+            if column_matches:
+                matches[(table_name, column_name)] = column_matches
+        return matches
+
+
+class ValueIndexBuilder:
+    """
+    Builds value indexes one at a time on a background thread, skipping databases whose
+    build is already pending. `on_built(db_id)` is called after each successful build.
+    """
+
+    def __init__(self, db_path: str, on_built: Callable[[str], None], **build_kwargs):
+        self.db_path = db_path
+        self.on_built = on_built
+        self.build_kwargs = build_kwargs
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="value-index")
+
+    def schedule(self, db_id: str) -> None:
+        with self._lock:
+            if db_id in self._pending:
+                return
+            self._pending.add(db_id)
+        self._executor.submit(self._build, db_id)
+
+    def _build(self, db_id: str) -> None:
+        try:
+            # serving workers share the database directory: let one of them build the index
+            with open(f"{value_index_path(self.db_path, db_id)}.lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                source_fingerprint = fingerprint(sqlite_path(self.db_path, db_id))
+                if ValueIndex.open(self.db_path, db_id, source_fingerprint) is None:
+                    build_value_index(self.db_path, db_id, **self.build_kwargs)
+        except Exception as e:
+            logger.warning(f"Could not index the content of {db_id}: {e}")
+            return
+        finally:
+            with self._lock:
+                self._pending.discard(db_id)
+        self.on_built(db_id)
@@ -0,0 +1,73 @@
+import logging
+import os
+import signal
+import socket
+from typing import Callable, Dict, Optional
+
+from uvicorn import Config, Server
+
+logger = logging.getLogger(__name__)
+
+
+def serve_forked(app, host: str, port: int, workers: int, on_fork: Optional[Callable[[], None]] = None) -> None:
+    """
+    Serves `app` from `workers` processes forked from the current one and accepting
+    connections on a shared listening socket.
+
+    Everything set up before the call, in particular the model weights and the PICARD
+    server, is shared with the workers: the weights stay in copy-on-write pages since
+    inference never writes them. Threads do not survive a fork, so anything that starts
+    threads must do so lazily. `on_fork` runs in every worker before it starts serving.
+    Workers that die are replaced until the parent receives SIGINT or SIGTERM.
+    """
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(worker_id: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if on_fork is not None:
+                    on_fork()
+                Server(Config(app=app, host=host, port=port)).run(sockets=[sock])
+            except BaseException:
+                logger.exception(f"Worker {worker_id} failed")
+                status = 1
+            finally:
+                # never unwind into the parent's context managers (e.g. the PICARD launcher)
+                os._exit(status)
+        children[pid] = worker_id
+        logger.warning(f"Started worker {worker_id} (pid {pid})")
+
+    def stop(signum, _frame) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for worker_id in range(workers):
+        spawn(worker_id)
+    try:
+        while children:
+            pid, status = os.wait()
+            worker_id = children.pop(pid, None)
+            if worker_id is not None and not stopping:
+                logger.warning(
+                    f"Worker {worker_id} (pid {pid}) exited with status {status}, restarting it")
+                spawn(worker_id)
+    finally:
+        sock.close()
@@ -8,6 +8,7 @@ from streamlit_extras.mention import mention
 import numpy as np
 import client
 import pandas as pd
+import json
 
 # @st.cache(allow_output_mutation=True)
 
@@ -17,6 +18,17 @@ def setup_pipeline(model: str, device: int = 0):
     model_name = model
 
 
+# Cached across reruns and sessions, so that reruns do not call the API again
+@st.cache_data(ttl=60, show_spinner=False)
+def list_dbs():
+    return client.get_list_dbs()
+
+
+@st.cache_data(ttl=3600, max_entries=512, show_spinner=False)
+def translate(question: str, db_id: str):
+    return client.get_translate(question, db_id)
+
+
 # ------------------ Constants ------------------
 # These "LM adapted" models are initialized from t5.1.1 (above) and train for an additional 100K steps on the LM objective discussed in the T5 paper. This adaptation improves the ability of the model to be used for prompt tuning.
 # https: // github.com/google-research/text-to-text-transfer-transformer/blob/main/released_checkpoints.md
@@ -85,8 +97,10 @@ with st.sidebar:
 with st.expander("🏬 Available DBs", True):
     # if clicked on button, get list of dbs
     if st.button("🔍 List DBs"):
-        dbs_list = client.get_list_dbs()
-        st.write(dbs_list)
+        try:
+            st.write(list_dbs())
+        except Exception as e:
+            st.error(f"🚧 Error:{e} 🚧")
 
 # Upload DB Form
 with st.expander("🆙 Upload SQLite DB", True):
@@ -97,12 +111,22 @@ with st.expander("🆙 Upload SQLite DB", True):
                         "FileType": uploaded_file.type,
                         "FileSize": uploaded_file.size}
         st.write(file_details)
-        # save file to disk
-        path = f'/database/{uploaded_file.name.split(".")[0]}'
-        os.makedirs(path, exist_ok=True)
-        with open(f'{path}/{uploaded_file.name}', "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        st.success("File successfully saved.")
+        # send it to the API, which validates it and swaps it in atomically, once per file
+        # rather than on every rerun
+        upload_key = (uploaded_file.name, uploaded_file.size)
+        if st.session_state.get('uploaded_file') != upload_key:
+            try:
+                uploaded = client.upload(uploaded_file.name, uploaded_file)
+                st.session_state['uploaded_file'] = upload_key
+                list_dbs.clear()
+                # translations of the replaced database are stale
+                translate.clear()
+                st.success("File successfully saved." if uploaded["changed"]
+                           else "This database is already up to date.")
+            except Exception as e:
+                st.error(f"🚧 Error:{e} 🚧")
+        else:
+            st.success("File successfully saved.")
 
 # Text2SQL Form
 with st.form(key="my_form"):
@@ -124,7 +148,7 @@ with st.form(key="my_form"):
         try:
             center_running()
             text_schema = st.session_state['text_schema']
-            output = client.get_translate(
+            output = translate(
                 st.session_state['text_question'],
                 st.session_state['text_db_id'])
             st.code(output[0]['query'], language='sql')
@@ -137,6 +161,32 @@ with st.form(key="my_form"):
         except Exception as e:
             st.error(f"🚧 Error:{e} 🚧")
 
+# Batch Form
+with st.expander("📚 Batch questions", False):
+    st.caption(
+        'A JSONL file with one `["db_id", "question"]` pair or `{"db_id": ..., "question": ...}` object per line.')
+    batch_file = st.file_uploader(
+        "Choose a file", type=["jsonl"], key="batch_file")
+    if batch_file is not None and st.button("✨ Generate SQL for all ✨"):
+        try:
+            questions = [json.loads(line) for line in batch_file.getvalue().decode().splitlines()
+                         if line.strip()]
+            progress, table = st.progress(0), st.empty()
+            answers = []
+            # answers arrive in the order they complete
+            for answer in client.ask_batch(questions):
+                answers.append({
+                    "index": answer["index"],
+                    "db_id": answer["db_id"],
+                    "question": answer["question"],
+                    "query": answer["results"][0]["query"] if answer.get("results") else None,
+                    "error": str(answer["error"]) if "error" in answer else None,
+                })
+                progress.progress(len(answers) / len(questions))
+                table.dataframe(pd.DataFrame(answers).sort_values("index"))
+        except Exception as e:
+            st.error(f"🚧 Error:{e} 🚧")
+
 # Proxy DB Form
 with st.expander("⚾ Proxy DB", False):
     with st.form(key="mysql_form"):
@@ -176,4 +226,7 @@ with st.expander("⚾ Proxy DB", False):
                 "password": st.session_state['text_password'],
                 "database": st.session_state['text_db_name'],
             }
-            st.info(client.proxy_mysql(config))
+            try:
+                st.info(client.proxy_mysql(config))
+            except Exception as e:
+                st.error(f"🚧 Error:{e} 🚧")
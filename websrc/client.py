@@ -1,31 +1,231 @@
-import requests
+import asyncio
+import json
 import os
+import random
+from typing import AsyncIterator, Iterable, Iterator, Optional, Sequence, Tuple, Union
+from urllib.parse import quote
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-BASE_URL = 'http://api:8000'
+BASE_URL = os.environ.get('EZ_PICARD_API', 'http://api:8000')
 HEADERS = {'accept': 'application/json'}
 
+# (connect, read) in seconds: generation can take a while on CPU
+TIMEOUT = (3.05, 120.0)
+# the API answers 503 when its queues are full
+RETRY_STATUSES = (502, 503, 504)
+
+Question = Union[Tuple[str, str], dict]
+
+
+def _ask_path(db_id: str, question: str) -> str:
+    # questions may contain "?" or "#"
+    return f"/ask/{quote(db_id, safe='')}/{quote(question, safe='')}"
+
+
+def _backoff(attempt: int, backoff_factor: float, retry_after: Optional[str] = None) -> float:
+    if retry_after is not None and retry_after.isdigit():
+        return float(retry_after)
+    return backoff_factor * (2 ** attempt) * (0.5 + random.random() / 2)
+
+
+class Client:
+    """
+    Client of the EZ-PICARD API over a pooled keep-alive session.
+
+    Idempotent requests are retried `retries` times with exponential backoff on connection
+    errors and on 502/503/504 (honoring Retry-After). Every request times out after
+    `timeout`, a (connect, read) pair in seconds.
+    """
+
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        timeout: Tuple[float, float] = TIMEOUT,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 10,
+    ):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset({'GET', 'HEAD'}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size,
+                              pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _request(self, method: str, path: str, **kwargs) -> requests.Response:
+        kwargs.setdefault('timeout', self.timeout)
+        response = self.session.request(method, f"{self.base_url}{path}", **kwargs)
+        response.raise_for_status()
+        return response
+
+    def list_dbs(self) -> list:
+        return self._request('GET', '/dbs').json()
+
+    def translate(self, question: str, db_id: str, limit: Optional[int] = None) -> list:
+        params = {'limit': limit} if limit else None
+        return self._request('GET', _ask_path(db_id, question), params=params).json()
+
+    def translate_stream(self, question: str, db_id: str, limit: Optional[int] = None) -> Iterator[dict]:
+        """
+        Yields the NDJSON lines of `GET /ask?stream=true`: `{"query"}` for every generated
+        query, then `{"row"}` for each of its rows as they are fetched, or `{"error"}`.
+        """
+        params = {'stream': 'true'}
+        if limit:
+            params['limit'] = limit
+        with self._request('GET', _ask_path(db_id, question), params=params, stream=True) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def ask_batch(self, questions: Iterable[Question], limit: Optional[int] = None) -> Iterator[dict]:
+        """
+        Sends `(db_id, question)` pairs or `{"db_id", "question", "id"}` objects to
+        `POST /ask/batch` and yields their answers in the order they complete. Every answer
+        carries the `index` of its question and either `results` or an `error`.
+        """
+        items = [item if isinstance(item, dict) else list(item)
+                 for item in questions]
+        params = {'limit': limit} if limit else None
+        # the read timeout applies between answers, not to the whole batch
+        with self._request('POST', '/ask/batch', json=items, params=params, stream=True) as response:
+            for line in response.iter_lines():
+                if line:
+                    yield json.loads(line)
+
+    def upload(self, name: str, file) -> dict:
+        """
+        Streams the SQLite database `file` (any binary file object) to the API as `name`.
+        """
+        return self._request('POST', '/upload/', files={'file': (name, file, 'application/octet-stream')}).json()
+
+    def proxy_mysql(self, config: dict) -> str:
+        connection_string = f"mysql://{config['user']}:{config['password']}@{config['host']}:{config['port']}/{config['database']}"
+        return self._request('POST', '/proxy/', json=connection_string).text
+
+
+class AsyncClient:
+    """
+    Asyncio variant of `Client` over an `httpx.AsyncClient`, with the same pooling,
+    timeouts and retries.
+    """
+
+    def __init__(
+        self,
+        base_url: str = BASE_URL,
+        timeout: Tuple[float, float] = TIMEOUT,
+        retries: int = 3,
+        backoff_factor: float = 0.5,
+        pool_size: int = 10,
+    ):
+        import httpx
+
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip('/'),
+            headers=HEADERS,
+            timeout=httpx.Timeout(timeout[1], connect=timeout[0]),
+            limits=httpx.Limits(max_connections=pool_size,
+                                max_keepalive_connections=pool_size),
+            # connection errors only, statuses are retried below
+            transport=httpx.AsyncHTTPTransport(retries=retries),
+        )
+
+    async def aclose(self):
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def _get(self, path: str, **kwargs):
+        for attempt in range(self.retries + 1):
+            response = await self.client.get(path, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                break
+            await asyncio.sleep(_backoff(attempt, self.backoff_factor, response.headers.get('retry-after')))
+        response.raise_for_status()
+        return response
+
+    async def list_dbs(self) -> list:
+        return (await self._get('/dbs')).json()
+
+    async def translate(self, question: str, db_id: str, limit: Optional[int] = None) -> list:
+        params = {'limit': limit} if limit else None
+        return (await self._get(_ask_path(db_id, question), params=params)).json()
+
+    async def translate_stream(self, question: str, db_id: str, limit: Optional[int] = None) -> AsyncIterator[dict]:
+        params = {'stream': 'true'}
+        if limit:
+            params['limit'] = limit
+        async with self.client.stream('GET', _ask_path(db_id, question), params=params) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    async def ask_batch(self, questions: Iterable[Question], limit: Optional[int] = None) -> AsyncIterator[dict]:
+        items = [item if isinstance(item, dict) else list(item)
+                 for item in questions]
+        params = {'limit': limit} if limit else None
+        async with self.client.stream('POST', '/ask/batch', json=items, params=params) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+
+# Shared by the whole Streamlit process, so that connections are kept alive across reruns
+_client: Optional[Client] = None
+
+
+def default_client() -> Client:
+    global _client
+    if _client is None:
+        _client = Client()
+    return _client
+
 
 def get_list_dbs():
-    url = f"{BASE_URL}/dbs"
-    response = requests.get(url, headers=HEADERS)
-    return response.json()
+    return default_client().list_dbs()
 
 
 def get_translate(question: str, db_id: str):
-    url = f"{BASE_URL}/ask/{db_id}/{question}"
-    response = requests.get(url, headers=HEADERS)
-    return response.json()
+    return default_client().translate(question, db_id)
 
 
-def upload(file: bytes):
-    url = f"{BASE_URL}/upload/"
-    resp = requests.post(url=url, data=file, headers={
-                         'Content-Type': 'application/octet-stream'})
-    return resp.text
+def upload(name: str, file):
+    return default_client().upload(name, file)
 
 
 def proxy_mysql(config):
-    url = f"{BASE_URL}/proxy/"
-    connection_string = f"mysql://{config['user']}:{config['password']}@{config['host']}:{config['port']}/{config['database']}"
-    response = requests.post(url, json=connection_string)
-    return response.text
+    return default_client().proxy_mysql(config)
+
+
+def ask_batch(questions: Sequence[Question], limit: Optional[int] = None) -> Iterator[dict]:
+    return default_client().ask_batch(questions, limit=limit)